@@ -0,0 +1,166 @@
+from grammar import AllOf, Factored, First, Lazy, OneOf, OneOrMore
+
+# Looks over a grammar graph for the shapes that make parsing slow or never
+# finish, without parsing anything.
+
+
+class Problem:
+    """
+    Something `analyze` found in `grammar`: `kind` is one of "left recursion",
+    "empty repetition", "unreachable alternative" or "overlapping alternatives",
+    and `message` says what and why.
+    """
+
+    def __init__(self, kind, grammar, message):
+        self.kind = kind
+        self.grammar = grammar
+        self.message = message
+
+    def __repr__(self):
+        return self.kind + ": " + self.message
+
+
+def analyze(root):
+    """
+    Returns a list of the `Problem`s in the grammar graph under `root`,
+    following every `Lazy`:
+
+    1) left recursion, a grammar that can get back to itself without
+       consuming a token, which recurses forever unless parsed in packrat mode;
+    2) a `OneOrMore` of a grammar that can match without consuming a token
+       (see `Grammar.nullable`), which loops forever;
+    3) an alternative of a `OneOf` that's never tried, because on any token it
+       can start with, an alternative before it is sure to match (see
+       `Grammar.certain_first`);
+    4) two alternatives of a `OneOf` that can start with the same token,
+       where the first isn't a single token (see `Grammar.single_token`), so
+       that when it fails after matching part of the input, the second parses
+       that part again.  Factoring out what they start with (see
+       `grammar.factor`), or packrat mode, avoids that.
+
+    A grammar of your own is taken to parse each of its `children` at the
+    index it's parsed at, as far as left recursion goes.
+    """
+    grammars = walk(root)
+    problems = []
+    problems.extend(left_recursion(grammars))
+    for grammar in grammars:
+        if isinstance(grammar, OneOrMore) and grammar.grammar.nullable():
+            problems.append(Problem("empty repetition", grammar,
+                                    describe(grammar) + " repeats a grammar that can match "
+                                    "without consuming a token, so loops forever"))
+        elif isinstance(grammar, OneOf):
+            problems.extend(alternatives(grammar))
+    return problems
+
+
+def walk(root):
+    "Returns the grammars in the graph under `root`, in the order they're reached."
+    seen = set([root])
+    grammars = [root]
+    for grammar in grammars:
+        for child in grammar.children():
+            if child not in seen:
+                seen.add(child)
+                grammars.append(child)
+    return grammars
+
+
+def leftmost(grammar):
+    "Returns the grammars `grammar` can parse at the index it's parsed at."
+    if isinstance(grammar, AllOf):
+        return leading(grammar.grammars)
+    elif isinstance(grammar, Factored):
+        children = leading(grammar.prefix)
+        if all(child.nullable() for child in grammar.prefix):
+            for branch in grammar.branches:
+                children.extend(leading(branch.grammars))
+        return children
+    else:
+        return grammar.children()
+
+
+def leading(grammars):
+    "Returns the grammars of a sequence up to and including the first that can't match empty."
+    children = []
+    for child in grammars:
+        children.append(child)
+        if not child.nullable():
+            break
+    return children
+
+
+def left_recursion(grammars):
+    "Returns a `Problem` for each set of grammars that are left-recursive through each other."
+    reaches = {}
+    for grammar in grammars:
+        reached = set()
+        pending = list(leftmost(grammar))
+        while pending:
+            child = pending.pop()
+            if child not in reached:
+                reached.add(child)
+                pending.extend(leftmost(child))
+        reaches[grammar] = reached
+    problems = []
+    reported = set()
+    for grammar in grammars:
+        if grammar in reaches[grammar] and grammar not in reported:
+            cycle = [other for other in grammars
+                     if other in reaches[grammar] and grammar in reaches[other]]
+            reported.update(cycle)
+            through = []
+            for other in cycle:
+                if describe(other) not in through + [describe(grammar)]:
+                    through.append(describe(other))
+            problems.append(Problem("left recursion", grammar,
+                                    describe(grammar) + " can be parsed again at the same index" +
+                                    (" through " + ", ".join(through) if through else "") +
+                                    ", which recurses forever unless parsed with packrat"))
+    return problems
+
+
+def alternatives(grammar):
+    "Returns the `Problem`s with the alternatives of the `OneOf` `grammar`."
+    problems = []
+    certain = First.NONE
+    reachable = []
+    for (position, alternative) in enumerate(grammar.grammars):
+        first = alternative.first()
+        if first != First.NONE and first.minus(certain) == First.NONE:
+            problems.append(Problem("unreachable alternative", grammar,
+                                    "alternative " + str(position) + " of " + describe(grammar) +
+                                    ", " + describe(alternative) + ", is never tried: an "
+                                    "alternative before it matches any token it can start with"))
+            continue
+        for (earlier, other) in reachable:
+            shared = other.first().intersection(first)
+            if shared != First.NONE and other.single_token() is None:
+                problems.append(Problem("overlapping alternatives", grammar,
+                                        "alternatives " + str(earlier) + " and " + str(position) +
+                                        " of " + describe(grammar) + ", " + describe(other) +
+                                        " and " + describe(alternative) + ", can both start with " +
+                                        describe_first(shared)))
+        reachable.append((position, alternative))
+        certain = certain.union(alternative.certain_first())
+    return problems
+
+
+def describe(grammar):
+    "The name or `trace_repr` of `grammar`, or of what it refers to if it's a `Lazy`, cut short."
+    seen = set()
+    while isinstance(grammar, Lazy) and grammar.name is None and grammar not in seen:
+        seen.add(grammar)
+        grammar = grammar.resolve()
+    description = repr(grammar)
+    if len(description) > 60:
+        description = description[:57] + "..."
+    return description
+
+
+def describe_first(first):
+    tokens = ", ".join(sorted(repr(token) for token in first.tokens))
+    if first.excluding:
+        return "any token" + (" but " + tokens if tokens else "")
+    else:
+        return tokens
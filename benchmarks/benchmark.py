@@ -0,0 +1,197 @@
+"""
+Measures how fast grammars parse generated inputs, and how much memory they
+use doing it, for telling whether a change to the library speeds parsing up
+or slows it down.  Run from the top of the repository:
+
+    python benchmarks/benchmark.py --save before.json
+    ... change something ...
+    python benchmarks/benchmark.py --compare before.json
+
+Each workload is parsed `--repeat` times, and the fastest time is reported as
+tokens per second.  With `tracemalloc` (python 3) the peak memory of a parse
+and the memory blocks its result holds on to are reported too.  `--compare`
+marks the workloads that got slower by more than `--threshold`, and exits
+with status 1 if any did.
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, "examples")]
+
+from cursor import Cursor
+from grammar import AllOf, AnyToken, Lazy, OneOf, OneOrMore, Token, Unless, compile, factor
+from bash_cartesian_product_grammar import top_level_expr
+from cartesian_product_parse import tokenize
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Workload:
+    """
+    A grammar and the tokens to parse with it, at `size`, and the options to
+    pass to `parse`.  `parse` is the method to call, "parse" or "recognize".
+    """
+
+    def __init__(self, name, grammar, tokens, parse = "parse", **options):
+        self.name = name
+        self.grammar = grammar
+        self.tokens = tokens
+        self.parse = parse
+        self.options = options
+
+    def run(self):
+        "Parses the tokens once, checking that the whole of them matched."
+        cursor = Cursor(self.tokens)
+        if self.parse == "recognize":
+            end = self.grammar.recognize(cursor)
+            result = end is not None
+        else:
+            (result, end) = self.grammar.parse(cursor, **self.options)
+            end = end.index
+        if not result or end != len(self.tokens):
+            raise Exception("Benchmark: " + self.name + " didn't parse to the end")
+        return result
+
+
+def workloads(scale):
+    "Returns the workloads, with their inputs `scale` times the default size."
+    def size(n):
+        return max(1, int(n * scale))
+
+    def nested(depth):
+        return tokenize("{a," * depth + "b" + "}" * depth)
+
+    flat = tokenize("x{" + ",".join("a" + str(i) for i in range(size(20000))) + "}y")
+
+    keywords = ["keyword" + str(i) for i in range(500)]
+    keyword = OneOf([Token(word) for word in keywords] + [Token(";")])
+    statements = [keywords[(i * 7919) % len(keywords)] if i % 10 else ";" for i in range(size(50000))]
+
+    run = [str(i % 10) for i in range(size(200000))]
+    item = Unless(Token(";"), AnyToken())
+
+    # every level of parentheses is parsed three times by the alternatives of
+    # `expr` without packrat or `factor`, so the work grows as 3 to the depth.
+    def arithmetic():
+        expr = OneOf([AllOf([Lazy(lambda: term), Token("+"), Lazy(lambda: expr)]),
+                      AllOf([Lazy(lambda: term), Token("-"), Lazy(lambda: expr)]),
+                      Lazy(lambda: term)])
+        term = OneOf([AllOf([Token("("), expr, Token(")")]), Token("1")])
+        return expr
+    expr = arithmetic()
+    parens = ["("] * size(7) + ["1"] + [")"] * size(7)
+    many_parens = ["("] * size(300) + ["1"] + [")"] * size(300)
+
+    compiled = compile(top_level_expr)
+    return [
+        Workload("flat braces", top_level_expr, flat),
+        Workload("flat braces, compiled", compiled, flat),
+        Workload("flat braces, recognize", top_level_expr, flat, "recognize"),
+        # nested braces are exponential without packrat
+        Workload("nested braces", top_level_expr, nested(size(11))),
+        Workload("nested braces, packrat", top_level_expr, nested(size(200)), packrat = True),
+        Workload("deeply nested braces, iterative", top_level_expr, nested(size(2000)),
+                 packrat = True, iterative = True),
+        Workload("keyword OneOf", OneOrMore(keyword), statements),
+        Workload("keyword OneOf, compiled", compile(OneOrMore(keyword)), statements),
+        Workload("OneOrMore run", OneOrMore(item), run),
+        Workload("OneOrMore run of maps", OneOrMore(item.map(lambda value, keeps: value)), run),
+        Workload("backtracking", expr, parens),
+        Workload("backtracking, packrat", expr, many_parens, packrat = True),
+        Workload("backtracking, factored", factor(arithmetic()), many_parens),
+    ]
+
+
+def measure(workload, repeat):
+    "Returns a dictionary of the measurements of `workload`."
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        workload.run()
+        times.append(timer() - start)
+    best = min(times)
+    measurements = {"tokens": len(workload.tokens), "seconds": best,
+                    "tokens per second": len(workload.tokens) / best if best else float("inf")}
+    if tracemalloc is not None:
+        gc.collect()
+        blocks = sys.getallocatedblocks()
+        tracemalloc.start()
+        result = workload.run()
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        gc.collect()
+        measurements["peak bytes"] = peak
+        measurements["result blocks"] = sys.getallocatedblocks() - blocks
+        del result
+    return measurements
+
+
+def report(name, measurements, before, threshold):
+    """
+    Prints a line of the table of results, compared with the `before`
+    measurements if given, and returns whether the workload got more than
+    `threshold` slower.
+    """
+    line = "%-36s %9d %14.0f %12s %13s" % (
+        name, measurements["tokens"], measurements["tokens per second"],
+        "%.0f" % (measurements["peak bytes"] / 1024.0) if "peak bytes" in measurements else "-",
+        measurements.get("result blocks", "-"))
+    slower = False
+    if before:
+        ratio = measurements["tokens per second"] / before["tokens per second"]
+        line += " %6.2fx" % ratio
+        if ratio < 1 - threshold:
+            line += " SLOWER"
+            slower = True
+    print(line)
+    sys.stdout.flush()
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmarks parsing generated inputs.")
+    parser.add_argument("--repeat", type = int, default = 5, help = "times to parse each input")
+    parser.add_argument("--scale", type = float, default = 1.0, help = "multiplies the size of the inputs")
+    parser.add_argument("--only", help = "runs only the workloads whose names contain this")
+    parser.add_argument("--save", help = "writes the results to this JSON file, as a baseline")
+    parser.add_argument("--compare", help = "compares the results with a baseline saved with --save")
+    parser.add_argument("--threshold", type = float, default = 0.1,
+                        help = "how much slower than the baseline counts as slower")
+    options = parser.parse_args()
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    baseline = None
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)
+    print("%-36s %9s %14s %12s %13s %s" % ("workload", "tokens", "tokens/sec", "peak KiB",
+                                          "result blocks", "vs baseline" if baseline else ""))
+    results = []
+    slower = []
+    for workload in workloads(options.scale):
+        if options.only and options.only not in workload.name:
+            continue
+        measurements = measure(workload, options.repeat)
+        results.append((workload.name, measurements))
+        if report(workload.name, measurements, baseline and baseline.get(workload.name), options.threshold):
+            slower.append(workload.name)
+    if options.save:
+        with open(options.save, "w") as file:
+            json.dump(dict(results), file, indent = 2, sort_keys = True)
+    if slower:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 from itertools import islice
 
-class Cursor:
+class Cursor(object):
     """
     Represents a cursor on a python list.  Provides non-destructive iteration
     over the list using a `head` and `tail` method, akin to a linked list,
@@ -9,6 +9,8 @@ class Cursor:
     The intention is to allow iteration over a list and holding onto different 
     tails in the list without copying or modifying anything.
     """
+
+    __slots__ = ('_list', 'index')
     
     def __init__(self, _list, index = 0):
         self._list = _list
@@ -18,7 +20,11 @@ class Cursor:
         return "Cursor: " + str([str(self._list[c]) for c in range(self.index, len(self._list))])
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return (isinstance(other, Cursor) and self.index == other.index and
+                (self._list is other._list or self._list == other._list))
+
+    def __ne__(self, other):
+        return not self == other
 
     def empty(self):
         "Returns true if this cursor is at the end of its list or its list is empty."
@@ -102,7 +108,45 @@ class Cursor:
                 if mapping:
                     mappings.append(mapping)
         return (mappings, cursor)
-    
 
-    
-    
+
+class Buffer(object):
+    """
+    Holds the tokens read so far from an iterator, for parsing input that
+    doesn't fit in a list all at once.  `tokens` is the list of them, and
+    `start` is the index in it where parsing continues.  The tokens before
+    `start` are no longer needed and are dropped as parsing moves along.
+    """
+
+    def __init__(self, iterable, size = 4096):
+        "Reads `size` tokens at a time from `iterable`."
+        self.source = iter(iterable)
+        self.tokens = []
+        self.start = 0
+        self.size = size
+        self.exhausted = False
+
+    def read(self, count):
+        if count > 0 and not self.exhausted:
+            length = len(self.tokens)
+            self.tokens.extend(islice(self.source, count))
+            self.exhausted = len(self.tokens) - length < count
+
+    def fill(self):
+        """
+        Reads tokens until there are at least `size` of them from `start`,
+        returning true if there are any.
+        """
+        self.read(self.size - (len(self.tokens) - self.start))
+        return self.start < len(self.tokens)
+
+    def grow(self):
+        "Doubles the number of tokens from `start`, or reads `size` more if that's more."
+        self.read(max(self.size, len(self.tokens) - self.start))
+
+    def advance(self, index):
+        "Moves `start` up to `index`, dropping the tokens before it once there's enough of them."
+        self.start = index
+        if index >= self.size:
+            del self.tokens[:index]
+            self.start = 0
@@ -41,6 +41,9 @@ def toOr(value, keeps):
     branches.append(last)
     return Or(branches)
 
+def keep_first(results, keeps):
+    return results[0]
+
 def toAnd(terms, keeps):
     # without this check, everything in the result tree
     # would get wrapped in its own `And`
@@ -62,9 +65,6 @@ literal = Lazy(lambda: AnyToken().map(toLit).rename("Lit"))
 # ending in the given delimiter token, which will be , or }
 def branch_ending_in(token):
 
-    def keep_first(results, keeps):
-        return results[0]
-
     # the contents of a branch is either one term or a conjunction of terms.
     # the `Unless` makes sure we don't capture the , or } as a literal.
     branch_contents = OneOrMore(OneOf([
@@ -91,10 +91,11 @@ _or = Lazy(lambda: AllOf([
 # such as "abc{d,e}", which is the conjunction of "abc" and "{d,e}"
 _and = Lazy(lambda: OneOrMore(OneOf([_or, literal])).map(toAnd).rename('And'))
 
-# the root parser
+# the root parser.  `freeze` resolves all the `Lazy`s above once, up front,
+# rather than on the first parse.
 top_level_expr = OneOf([_and,
                         _or,
-                        literal]).rename("top_level_expr")
+                        literal]).rename("top_level_expr").freeze()
 
 
 
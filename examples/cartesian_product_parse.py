@@ -1,5 +1,6 @@
-import re
 from cursor import Cursor
+from lexer import Lexer
+from parallel import parse_many
 from bash_cartesian_product_grammar import top_level_expr, Empty
 
 def parse(string):
@@ -13,10 +14,24 @@ def parse(string):
     return (result and result.value) or Empty()
 
 
+# the delimiters and the runs of characters between them
+lexer = Lexer([("delimiter", "[{},]"), ("text", "[^{},]+")])
+
 def create_cursor(string):
-    # includes the delimiters and characters between them
-    tokens = re.split('([{},])', string)
-    non_empty = [token for token in tokens if token != ""]
-    return Cursor(non_empty)
+    return Cursor(tokenize(string))
+
+def tokenize(string):
+    return lexer.tokenize(string)
+
+
+def parse_all(strings, workers = None):
+    """
+    Parses many strings as `parse` does, in parallel worker processes,
+    yielding the syntax tree of each in turn.
+    """
+    outcomes = parse_many("bash_cartesian_product_grammar.top_level_expr", strings, workers,
+                          tokenize = "cartesian_product_parse.tokenize")
+    for (result, _) in outcomes:
+        yield (result and result.value) or Empty()
 
 
@@ -1,6 +1,14 @@
 import abc
-from cursor import Cursor
-from itertools import repeat
+import pickle
+import re
+from array import array
+from inspect import getmro
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    from inspect import getargspec
+from cursor import Cursor, Buffer
+from tracing import PrintTracer
 
 # A lightweight parser combinator library, i.e., lets you define a simple grammar
 # by composing more complex grammar expressions out of simpler ones.
@@ -13,39 +21,110 @@ from itertools import repeat
 # c) http://www.lihaoyi.com/fastparse/ (the "parse" part, not the "fast" part)
 #
 
-def trace(level, *args):
-    print("".join(repeat("-", level)) + ", ".join(map(str, args)))
-
 class Grammar:
     """
     Represents a grammar tree that will parse a string into some top-level value
     and a dictionary of items captured along the way.
     """
 
+    # True to print each grammar as it's parsed, or a `tracing.Tracer`
     trace = False
 
+    # the function `recognize` compiles, the first time it's called
+    recognizer = None
+
     def __init__(self, name = None):
         self.name = name
+        if self.__class__ not in cursor_styles:
+            cursor_style(self.__class__)
+
+    def __getstate__(self):
+        # the recognizer is made of closures, so it's compiled again after loading
+        state = dict(self.__dict__)
+        state.pop('recognizer', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.__class__ not in cursor_styles:
+            cursor_style(self.__class__)
 
     def __repr__(self):
         return self.name or self.trace_repr()
 
-    def parse(self, cursor, level = 0):
-        if cursor.empty():
-            return (None, cursor)
-        else:
+    def parse(self, cursor, level = 0, packrat = False, iterative = False, deferred = False,
+              profile = None):
+        """
+        Parses the input at `cursor`, returning a pair of the `Result` (falsy if
+        this Grammar doesn't match) and the cursor where it ended up.
 
-            if Grammar.trace:
-                trace(level, (self, cursor))
+        With `packrat`, every sub-grammar's outcome at each position is
+        memoized for the duration of this call, see `ParseState`.
 
-            (result, end) = self.parse_non_empty(cursor, level)
+        With `iterative`, the grammar tree is walked on an explicit stack rather
+        than the python call stack, so the nesting of the input is limited only
+        by memory, see `ParseState.apply_iterative`.
 
-            if result and Grammar.trace:
-                trace(level, "*** match:", self)
-            elif Grammar.trace:
-                trace(level, "--- no-match:", self)
+        With `deferred`, the functions given to `map` aren't called during the
+        parse, only once it's done, on the parts of the input that make up
+        the final match, see `Deferred`.
 
-            return (result, end)
+        Given a `profiler.Profile`, records how long each grammar took and
+        what it matched in it.
+
+        This is the only place a `Cursor` is taken apart or built: below it,
+        grammars pass around the cursor's list and an index into it.
+        """
+        if profile is not None:
+            state = profile.state(packrat, iterative, deferred)
+        else:
+            state = ParseState(packrat, iterative, deferred = deferred)
+        (result, end) = state.apply(self, cursor._list, cursor.index, level)
+        if deferred and result:
+            result = result.forced()
+        return (result, cursor if end == cursor.index else cursor.at(end))
+
+    def parse_stream(self, tokens, packrat = False, iterative = False):
+        """
+        Parses an iterable of tokens, such as a generator, the way
+        `OneOrMore(self)` would, but yields the `Result` of each match of this
+        Grammar as soon as it's parsed, holding in memory only the tokens from
+        the start of the match in progress (see `cursor.Buffer`).
+
+        Stops at the end of the tokens or where this Grammar doesn't match.
+        """
+        buffer = Buffer(tokens)
+        while buffer.fill():
+            start = buffer.start
+            state = ParseState(packrat, iterative, partial = not buffer.exhausted)
+            try:
+                (result, end) = state.apply(self, buffer.tokens, start, 0)
+            except MoreInput:
+                # reached the end of what's been read, so reparse with more
+                buffer.grow()
+                continue
+            if not result or end == start:
+                return
+            yield result
+            buffer.advance(end)
+
+    def recognize(self, cursor):
+        """
+        Returns the index where this Grammar's match at `cursor` ends, or None
+        if it doesn't match, without building any `Result`: `map`, `mapResult`
+        and `keep` are skipped entirely, so use it when you only need to know
+        whether, or how far, the input matches.
+
+        Matching is then decided by the grammars alone, so a `mapResult`
+        function that fails a match by returning a falsy value, or a `map` on
+        a falsy value, doesn't fail it here.  The grammar is compiled into
+        a recognizer the first time, see `compile_recognizer`.
+        """
+        recognizer = self.recognizer
+        if recognizer is None:
+            recognizer = self.recognizer = Compiler(recognize = True).compile(self)
+        end = recognizer(cursor._list, cursor.index)
+        return None if end is Commit.FAILED else end
 
     def mapResult(self, f):
         return MapResult(f, self)
@@ -60,45 +139,727 @@ class Grammar:
     def clear(self):
         return Clear(self)
 
+    def packrat(self):
+        return Packrat(self)
+
+    def commit(self):
+        return Commit(self)
+
+    def commits(self):
+        "Returns true if this is a `Commit`, perhaps mapped, see `AllOf`."
+        return False
+
+    def children(self):
+        "Returns the grammars this one is composed of."
+        return []
+
+    def nullable(self, seen = None):
+        """
+        Returns true if this grammar can match without consuming a token.  None
+        of the built-in grammars can, unless made of ones that can, but a
+        grammar of your own that can should override this, so that
+        `analyzer.analyze` can warn of a `OneOrMore` of it, which loops forever.
+        """
+        return False
+
+    def fails_committed(self, seen = None):
+        """
+        Returns true if this grammar can fail with `Commit.FAILED`, which stops
+        a `OneOf` it's an alternative of from trying the ones after it, see
+        `OneOf.certain_first`.  A grammar of your own that passes on the
+        results of its sub-grammars should override this.
+        """
+        return False
+
+    def first(self, seen = None):
+        """
+        Returns the `First` set of tokens this grammar can match starting with.
+        `seen` is the set of `Lazy`s being expanded, to stop at cycles.
+        """
+        return First.ANY
+
+    def certain_first(self, seen = None):
+        """
+        Returns the `First` set of tokens on which this grammar is sure to match,
+        whatever tokens follow.
+        """
+        return First.NONE
+
+    def single_token(self, seen = None):
+        """
+        If this grammar only ever matches a single token, and whether it does
+        depends on nothing but that token, returns a pair of:
+        1) the `First` set of the tokens it matches, and
+        2) None if its `Result` is just the token, otherwise a function from
+           a token in the set to the Result, which may be falsy after all.
+        Otherwise returns None.  Lets `OneOrMore` match a run of such tokens
+        in one loop.
+        """
+        return None
+
+    def finalize(self):
+        "Precomputes anything this grammar can once its whole graph is resolved."
+
+    def freeze(self):
+        """
+        Walks the whole grammar graph under this one, resolving every `Lazy`
+        in it, so the cost of building the graph is paid here once rather
+        than during parsing.  Returns this grammar.
+        """
+        seen = set([self])
+        pending = [self]
+        while pending:
+            for child in pending.pop().children():
+                if child not in seen:
+                    seen.add(child)
+                    pending.append(child)
+        for grammar in seen:
+            grammar.finalize()
+        return self
+
     @abc.abstractmethod
     def rename(self, name):
         """
         Returns an instance of this Grammar assigned the given name for debugging"
         """
     
-    @abc.abstractmethod
-    def parse_non_empty(self, cursor, level):
+    def parse_tokens(self, tokens, index, level, state):
         """
         Returns a pair:
         1) A `Result`, defined below, or falsy if this Grammar doesn't match the input.
-        2) The cursor where it ended up after matching this grammar.
+        2) The index in `tokens` where it ended up after matching this grammar.
+
+        `index` is always before the end of `tokens`.
+        Sub-grammars are parsed with `state.apply(grammar, tokens, index, level + 1)`.
+
+        Grammars can instead implement `parse_non_empty(cursor, level, state)`,
+        working with a `Cursor` as in `parse`, and parse sub-grammars
+        with `state.apply_cursor(grammar, cursor, level + 1)`.
+
+        Grammars written before there was a `ParseState`, which implement
+        `parse_non_empty(cursor, level)`, or override `parse(cursor, level)`
+        instead, still work, as do subclasses of the built-in grammars that
+        do, see `cursor_style`.
+        """
+        (style, stateless, inherited) = cursor_styles.get(self.__class__) or cursor_style(self.__class__)
+        cursor = Cursor(tokens, index)
+        if style == "parse" and (self, index) not in overriding:
+            overriding.add((self, index))
+            try:
+                (result, end) = self.parse(cursor, level)
+            finally:
+                overriding.discard((self, index))
+        elif style == "parse" and inherited is not None:
+            # the override of `parse` called the one it overrides, which got back here
+            return inherited(self, tokens, index, level, state)
+        elif stateless:
+            (result, end) = self.parse_non_empty(cursor, level)
+        else:
+            (result, end) = self.parse_non_empty(cursor, level, state)
+        return (result, end.index)
+
+    def parse_steps(self, tokens, index, level, state):
+        """
+        The same parse as `parse_tokens`, as a generator for the iterative
+        engine (see `ParseState.apply_iterative`).  Rather than calling
+        `state.apply` for a sub-grammar, it yields `(grammar, index, level + 1)`
+        and is sent back the sub-grammar's `(result, end)`.  Its own
+        `(result, end)` is the last thing it yields.
+
+        This default parses the whole grammar in one step with `parse_tokens`,
+        so grammars that don't override it still work, using the call stack.
+        """
+        yield self.parse_tokens(tokens, index, level, state)
+
+    def compile_parser(self, compiler):
+        """
+        Returns a function `parse(tokens, index)` equivalent to `self.parse`,
+        but over a list of tokens and an index into it rather than a `Cursor`,
+        and returning the end index rather than an end `Cursor`.
+        Sub-grammars are compiled with `compiler.compile(grammar)`.
+
+        This default just calls back into `parse`; the built-in grammars
+        override it to generate closures that call each other directly.
+        It can't parse tokens interned with a `Vocabulary`, so raises if the
+        compiler has one.
+        """
+        compiler.no_vocabulary(self)
+        grammar = self
+        def parse(tokens, index):
+            return ParseState().apply(grammar, tokens, index, 0)
+        return parse
+
+    def compile_recognizer(self, compiler):
         """
+        Returns a function `recognize(tokens, index)` for `Grammar.recognize`,
+        returning the end index of a match, None if there isn't one, or
+        `Commit.FAILED` for the same failure as `parse_tokens` returns it.
+        Sub-grammars are compiled with `compiler.compile(grammar)`.
+
+        This default parses the whole grammar and drops its `Result`, so
+        like `compile_parser` raises if the compiler has a `Vocabulary`.
+        """
+        compiler.no_vocabulary(self)
+        grammar = self
+        failed = Commit.FAILED
+        def recognize(tokens, index):
+            (result, end) = ParseState().apply(grammar, tokens, index, 0)
+            if result:
+                return end
+            else:
+                return failed if result is failed else None
+        return recognize
+
+
+def cursor_style(cls):
+    """
+    Returns how `Grammar.parse_tokens` parses a grammar of the class `cls`
+    written against a `Cursor`, as a triple of:
+    1) "parse_non_empty" if it implements `parse_non_empty`, "parse" if it
+       only overrides `parse(cursor, level)`, or None if it implements
+       `parse_tokens` instead;
+    2) whether its `parse_non_empty` takes `(cursor, level)` rather than
+       `(cursor, level, state)`, as grammars written before there was a
+       `ParseState` do;
+    3) the `parse_tokens` of the built-in grammar `cls` subclasses, if any.
+    Grammars that take no state, or override `parse`, parse their
+    sub-grammars with `parse`, each afresh, so not in packrat or any other mode.
+
+    Only a `parse_non_empty` or `parse` defined below the `parse_tokens` it
+    inherits counts, and then the built-in grammar's `parse_tokens`,
+    `parse_steps`, compiling and `first` sets, which describe its own
+    parsing, are replaced in `cls` by `Grammar`'s.
+    """
+    classes = getmro(cls)
+    def defined(name):
+        "The position in `classes` of the one that defines `name`."
+        for (position, defining) in enumerate(classes):
+            if name in defining.__dict__:
+                return position
+        return len(classes)
+    parse_tokens = defined('parse_tokens')
+    inherited = None
+    if classes[parse_tokens] is not Grammar:
+        inherited = classes[parse_tokens].__dict__['parse_tokens']
+    if defined('parse_non_empty') < parse_tokens:
+        style = "parse_non_empty"
+    elif defined('parse') < parse_tokens:
+        style = "parse"
+    else:
+        style = None
+    stateless = False
+    method = getattr(cls, 'parse_non_empty', None)
+    if method is not None:
+        spec = getargspec(getattr(method, '__func__', method))
+        stateless = spec.varargs is None and len(spec.args) < 4
+    if style is not None and inherited is not None:
+        for name in ('parse_tokens', 'parse_steps', 'compile_parser', 'compile_recognizer',
+                     'first', 'certain_first', 'single_token'):
+            setattr(cls, name, Grammar.__dict__[name])
+    cursor_styles[cls] = (style, stateless, inherited)
+    return cursor_styles[cls]
+
+# the `cursor_style` of each class of grammar made so far
+cursor_styles = {}
+
+# the grammars, and the indexes, that `Grammar.parse_tokens` is calling an
+# overridden `parse` of
+overriding = set()
+
+
+class ParseState:
+    """
+    The state shared by all the grammars taking part in one call to
+    `Grammar.parse`, so it is scoped to a single input and dropped
+    along with it when the parse returns.
+
+    `apply` is how a Grammar parses one of its sub-grammars.  In packrat
+    mode it first looks in `memo`, which records the `(result, end)` that
+    each grammar produced at each index of the input, so a sub-grammar that
+    a `OneOf` backtracks over is parsed at most once per position.
+
+    Packrat mode also supports left-recursive grammars, direct or indirect,
+    by growing a seed parse as described in Warth et al., "Packrat Parsers
+    Can Support Left Recursion" (2008).  `recursions` is the stack of grammars
+    currently being parsed for the first time at their index, and `heads` maps
+    an index to the left recursion being grown there.
+
+    In iterative mode `apply` is `apply_iterative`, which memoizes the same
+    way in packrat mode but doesn't support left recursion.
+
+    In partial mode the tokens are only the start of the input, as read so
+    far from a stream by `Grammar.parse_stream`, see `end_of_input`.
+
+    In deferred mode a `Map` leaves its function to be called on the final
+    match, see `Deferred`.
+
+    `tracer` is the `tracing.Tracer` that `Grammar.trace` was set to when the
+    parse started, if any.  `apply_traced` then takes the place of
+    `apply_plain`, so that a parse without one doesn't check for it.
+
+    `plain` is true in none of these modes.
+    """
+
+    def __init__(self, packrat = False, iterative = False, partial = False, deferred = False):
+        self.iterative = iterative
+        self.partial = partial
+        self.deferred = deferred
+        self.plain = not (packrat or iterative or partial or deferred)
+        tracer = Grammar.trace
+        self.tracer = (PrintTracer() if tracer is True else tracer) or None
+        if self.tracer is not None:
+            self.apply_plain = self.apply_traced
+        if packrat:
+            self.memo = {}
+            self.heads = {}
+            self.recursions = None
+            self.apply = self.apply_memo if self.tracer is None else self.apply_memo_traced
+        else:
+            self.memo = None
+            self.apply = self.apply_plain
+        if iterative:
+            self.apply = self.apply_iterative
+
+    def memoized(self):
+        "Returns a new state in the same modes as this one, and packrat mode, for a `Packrat`."
+        return ParseState(True, self.iterative, self.partial, self.deferred)
+
+    def apply_cursor(self, grammar, cursor, level):
+        "Parses `grammar` at `cursor` as `apply` does, returning the end as a `Cursor`."
+        (result, end) = self.apply(grammar, cursor._list, cursor.index, level)
+        return (result, cursor.at(end))
+
+    def end_of_input(self, index):
+        """
+        The outcome of a grammar asked to parse at `index`, the end of the
+        tokens.  In partial mode there are more tokens to come, so rather than
+        failing it raises `MoreInput` to have the parse retried with them.
+        """
+        if self.partial:
+            raise MoreInput(index)
+        return (None, index)
+
+    def apply_plain(self, grammar, tokens, index, level):
+        if index >= len(tokens):
+            return self.end_of_input(index)
+        else:
+            return grammar.parse_tokens(tokens, index, level, self)
+
+    def apply_traced(self, grammar, tokens, index, level):
+        "Parses `grammar` as `apply_plain` does, telling `tracer` about it."
+        if index >= len(tokens):
+            return self.end_of_input(index)
+        else:
+            tracer = self.tracer
+            tracer.enter(grammar, tokens, index, level)
+            (result, end) = grammar.parse_tokens(tokens, index, level, self)
+            if result:
+                tracer.match(grammar, index, end, level)
+            else:
+                tracer.fail(grammar, index, level)
+            return (result, end)
+
+    def apply_memo_traced(self, grammar, tokens, index, level):
+        "Parses `grammar` as `apply_memo` does, telling `tracer` if it's memoized."
+        outcome = self.memo.get(index, {}).get(grammar)
+        if isinstance(outcome, tuple) and index not in self.heads:
+            self.tracer.memo(grammar, index, level)
+        return self.apply_memo(grammar, tokens, index, level)
+
+    def apply_memo(self, grammar, tokens, index, level):
+        if index >= len(tokens):
+            return self.end_of_input(index)
+
+        at_index = self.memo.get(index)
+        if at_index is None:
+            at_index = self.memo[index] = {}
+        outcome = at_index.get(grammar)
+
+        head = self.heads.get(index)
+        if head is not None:
+            if outcome is None and not head.involves(grammar):
+                # not part of the recursion being grown here, so parse it
+                # without memoizing what it makes of the partly grown seed.
+                return self.apply_plain(grammar, tokens, index, level)
+            if grammar in head.to_eval:
+                head.to_eval.remove(grammar)
+                outcome = at_index[grammar] = self.apply_plain(grammar, tokens, index, level)
+                return outcome
+
+        if outcome is None:
+            return self.apply_first(grammar, tokens, index, level, at_index)
+        elif isinstance(outcome, LeftRecursion):
+            outcome.detected(self.recursions)
+            return outcome.seed
+        else:
+            return outcome
+
+    def apply_iterative(self, grammar, tokens, index, level):
+        """
+        Parses `grammar` at `index` as `apply_plain` or `apply_memo` would, but
+        instead of recursing into sub-grammars it keeps the `parse_steps`
+        generator of each grammar being parsed on the `frames` stack, feeding
+        each the outcome of the sub-grammar it asked for.
+        """
+        length = len(tokens)
+        memo = self.memo
+        tracer = self.tracer
+        frames = []
+        step = (grammar, index, level)
+        while True:
+            if len(step) == 3:
+                (grammar, index, level) = step
+                outcome = None
+                if index >= length:
+                    outcome = self.end_of_input(index)
+                elif memo is not None:
+                    at_index = memo.get(index)
+                    if at_index is None:
+                        at_index = memo[index] = {}
+                    outcome = at_index.get(grammar)
+                    if outcome is ParseState.IN_PROGRESS:
+                        raise Exception("Iterative parse: " + str(grammar) + " is left-recursive "
+                                        "at index " + str(index) + ", use the recursive engine")
+                    elif outcome is not None and tracer is not None:
+                        tracer.memo(grammar, index, level)
+                if outcome is None:
+                    if tracer is not None:
+                        tracer.enter(grammar, tokens, index, level)
+                    if memo is not None:
+                        at_index[grammar] = ParseState.IN_PROGRESS
+                    frames.append((grammar.parse_steps(tokens, index, level, self),
+                                   grammar, index, level))
+            else:
+                outcome = step
+                (_, grammar, index, level) = frames.pop()
+                if memo is not None:
+                    memo[index][grammar] = outcome
+                if tracer is not None:
+                    if outcome[0]:
+                        tracer.match(grammar, index, outcome[1], level)
+                    else:
+                        tracer.fail(grammar, index, level)
+            if not frames:
+                return outcome
+            # a frame that was just pushed is started by sending it None.
+            step = frames[-1][0].send(outcome)
+
+    # the memo entry of a grammar while apply_iterative is parsing it.
+    IN_PROGRESS = object()
+
+    def apply_first(self, grammar, tokens, index, level, at_index):
+        "Parses `grammar` at `index` for the first time, watching for left recursion."
+        recursion = LeftRecursion(grammar, index, self.recursions)
+        self.recursions = recursion
+        at_index[grammar] = recursion
+        outcome = self.apply_plain(grammar, tokens, index, level)
+        self.recursions = recursion.next
+
+        if recursion.head is None:
+            at_index[grammar] = outcome
+            return outcome
+        elif recursion.head.grammar is not grammar:
+            # involved in a recursion headed further up the stack,
+            # which will re-parse it while growing its seed.
+            recursion.seed = outcome
+            return outcome
+        else:
+            at_index[grammar] = outcome
+            if outcome[0]:
+                return self.grow(grammar, tokens, index, level, at_index, recursion.head)
+            else:
+                return outcome
+
+    def grow(self, grammar, tokens, index, level, at_index, head):
+        """
+        Re-parses the head of a left recursion, each time with the previous
+        match memoized as the seed for the recursive reference, until the
+        match stops getting longer.
+        """
+        self.heads[index] = head
+        while True:
+            head.to_eval = set(head.involved)
+            outcome = self.apply_plain(grammar, tokens, index, level)
+            if not outcome[0] or outcome[1] <= at_index[grammar][1]:
+                break
+            at_index[grammar] = outcome
+        del self.heads[index]
+        return at_index[grammar]
+
+
+class MoreInput(Exception):
+    "Raised by a partial `ParseState` when a grammar reaches the end of the tokens read so far."
+
+    def __init__(self, index):
+        Exception.__init__(self, "more input needed at index " + str(index))
+        self.index = index
+
+
+class LeftRecursion:
+    """
+    The memo entry of a grammar while it is being parsed at an index for the
+    first time.  Finding it there again means the grammar is left-recursive,
+    and it answers with `seed`, which starts out as a failure.
+    """
+
+    def __init__(self, grammar, index, next):
+        self.grammar = grammar
+        self.seed = (None, index)
+        self.head = None
+        self.next = next
+
+    def detected(self, stack):
+        "Marks the grammars on `stack` above this one as involved in its recursion."
+        if self.head is None:
+            self.head = RecursionHead(self.grammar)
+        entry = stack
+        while entry is not None and entry.head is not self.head:
+            entry.head = self.head
+            self.head.involved.add(entry.grammar)
+            entry = entry.next
+
+
+class RecursionHead:
+    """
+    The grammar at which a left recursion was entered, along with the other
+    grammars `involved` in it, which are re-parsed on each round of growing
+    its seed.
+    """
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.involved = set()
+        self.to_eval = set()
+
+    def involves(self, grammar):
+        return grammar is self.grammar or grammar in self.involved
 
  
-class Result:
+class Result(object):
+
+    __slots__ = ('value', 'kept')
 
     def __init__(self, value, keeps = None):
         """
         `value` is the specific result of the Grammar that matched the input.
-        `keeps` is a dictionary of values kept during parsing using `keep`.
+        `keeps` is a dictionary of values kept during parsing using `keep`,
+        or the `Keeps` they are held in while parsing.
         """
         self.value = value
-        self.keeps = keeps or dict()        
+        if keeps is None or isinstance(keeps, Keeps):
+            self.kept = keeps
+        elif keeps:
+            self.kept = Keeps(items = keeps)
+        else:
+            self.kept = None
+
+    @property
+    def keeps(self):
+        "The dictionary of values kept during parsing using `keep`."
+        if self.kept is None:
+            return {}
+        else:
+            return self.kept.to_dict()
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return (isinstance(other, Result) and
+                self.value == other.value and self.keeps == other.keeps)
+
+    def __ne__(self, other):
+        return not self == other
 
     def __repr__(self):
         return "Result(" + str(self.value) + ", " + str(self.keeps) + ")"
         
+    def forced(self):
+        "Returns this Result with any `Deferred` values in it, or in its keeps, computed."
+        if self.kept is None:
+            return Result(force(self.value))
+        else:
+            return Result(force(self.value), force_all(self.keeps))
+
     @staticmethod
     def merge_all(results):
-        all_values = map(lambda r: r.value, results)
-        all_keeps = {}
-        for result in results:
-            all_keeps.update(result.keeps)
-        return Result(all_values, all_keeps)
-        
+        all_values = [result.value for result in results]
+        all_kept = [result.kept for result in results if result.kept is not None]
+        if not all_kept:
+            return Result(all_values)
+        elif len(all_kept) == 1:
+            return Result(all_values, all_kept[0])
+        else:
+            return Result(all_values, Keeps(all_kept))
+
+
+class Keeps(object):
+    """
+    The values kept during parsing, as a persistent map that shares structure
+    with the `Keeps` it's built from rather than copying them: it is the
+    `parents` merged in order, then updated with `items`.  It's only turned
+    into a dictionary, by `to_dict`, when something reads `Result.keeps`.
+    """
+
+    __slots__ = ('parents', 'items', 'dict')
+
+    def __init__(self, parents = (), items = None):
+        self.parents = parents
+        self.items = items
+        self.dict = items if not parents else None
+
+    def __contains__(self, key):
+        pending = [self]
+        while pending:
+            keeps = pending.pop()
+            if keeps.dict is not None:
+                if key in keeps.dict:
+                    return True
+            else:
+                if keeps.items and key in keeps.items:
+                    return True
+                pending.extend(keeps.parents)
+        return False
+
+    def to_dict(self):
+        if self.dict is None:
+            merged = {}
+            # depth first through the parents, so later values replace earlier ones
+            pending = [self]
+            while pending:
+                keeps = pending.pop()
+                if isinstance(keeps, dict):
+                    merged.update(keeps)
+                elif keeps.dict is not None:
+                    merged.update(keeps.dict)
+                else:
+                    if keeps.items:
+                        pending.append(keeps.items)
+                    pending.extend(reversed(keeps.parents))
+            self.dict = merged
+        return self.dict
+
+
+class Deferred(object):
+    """
+    The value of a `Map` parsed in deferred mode (see `Grammar.parse`): rather
+    than calling the map's function `f` on the `Result` its grammar matched,
+    which is wasted work when a `OneOf` or `AllOf` further up backtracks over
+    the match, it holds on to the Result until `force` is called, when the
+    whole parse is done.  `force` calls `f` once, however many Results
+    share this value, e.g. through the memo table in packrat mode.
+
+    A Map only matches if its grammar's value is truthy, so a `Map` of a
+    `Map` matches in deferred mode even if the inner function returns a
+    falsy value.  Parse without deferring if your functions do that.
+    """
+
+    __slots__ = ('f', 'result', 'value')
+
+    def __init__(self, f, result):
+        self.f = f
+        self.result = result
+
+    def force(self):
+        return force(self)
+
+
+def force(value):
+    """
+    Returns `value`, with any `Deferred` in it, or in the lists in it, computed.
+    The values of deeply nested input are nested as deeply, so rather than
+    recursing this works through them on an explicit stack of steps: a value
+    to force, or a list or `Deferred` to build from the forced values of its
+    items, which are on the `forced` stack by then.
+    """
+    if not isinstance(value, (Deferred, list)):
+        return value
+    forced = []
+    steps = [(value, None)]
+    while steps:
+        (value, items) = steps.pop()
+        if items is not None:
+            # the forced values of `items` are the last ones on `forced`
+            values = forced[len(forced) - len(items):]
+            del forced[len(forced) - len(items):]
+            if isinstance(value, list):
+                forced.append(values)
+            else:
+                if value.f is not None:
+                    keeps = dict(zip(items[1:], values[1:]))
+                    value.value = value.f(values[0], keeps)
+                    value.f = value.result = None
+                forced.append(value.value)
+        elif isinstance(value, Deferred):
+            if value.f is None:
+                forced.append(value.value)
+                continue
+            keeps = value.result.keeps
+            keys = list(keeps)
+            steps.append((value, [None] + keys))
+            steps.extend((keeps[key], None) for key in reversed(keys))
+            steps.append((value.result.value, None))
+        elif isinstance(value, list):
+            steps.append((value, value))
+            steps.extend((item, None) for item in reversed(value))
+        else:
+            forced.append(value)
+    return forced[0]
+
+
+def force_all(keeps):
+    return dict((key, force(value)) for (key, value) in keeps.items())
+
+
+class First:
+    """
+    A set of tokens that a grammar's match can start with, i.e. its FIRST set:
+    either exactly `tokens`, or if `excluding`, any token except `tokens`.
+    """
+
+    def __init__(self, tokens = (), excluding = False):
+        self.tokens = frozenset(tokens)
+        self.excluding = excluding
+
+    def __eq__(self, other):
+        return self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return ("First(any except " if self.excluding else "First(") + str(sorted(self.tokens)) + ")"
+
+    def __contains__(self, token):
+        try:
+            return (token in self.tokens) != self.excluding
+        except TypeError:
+            # an unhashable token, which can't be one of `tokens`
+            return self.excluding
+
+    def union(self, other):
+        if self.excluding and other.excluding:
+            return First(self.tokens & other.tokens, True)
+        elif self.excluding:
+            return First(self.tokens - other.tokens, True)
+        elif other.excluding:
+            return First(other.tokens - self.tokens, True)
+        else:
+            return First(self.tokens | other.tokens)
+
+    def minus(self, other):
+        if self.excluding and other.excluding:
+            return First(other.tokens - self.tokens)
+        elif self.excluding:
+            return First(self.tokens | other.tokens, True)
+        elif other.excluding:
+            return First(self.tokens & other.tokens)
+        else:
+            return First(self.tokens - other.tokens)
+
+    def intersection(self, other):
+        return self.minus(First(other.tokens, not other.excluding))
+
+First.NONE = First()
+First.ANY = First(excluding = True)
+
 
 ########################################################################
 # Grammars that define syntactic structure, i.e. the recursive descent
@@ -124,16 +885,94 @@ class Lazy(Grammar):
 
     Then the forward reference will only be resolved when needed during parsing,
     and `addition` and `subtraction` will have been already defined.
+    The thunk is only called once, the first time it's needed, and the grammar
+    it returns is reused from then on.  Call `freeze` on the root of a grammar
+    to resolve all of its `Lazy`s up front.
+
+    `expr` is also left-recursive, i.e. `addition` refers back to `expr` before
+    consuming any input, so it only terminates when parsed in packrat mode.
     """
     def __init__(self, thunk, name = None):
         Grammar.__init__(self, name)        
         self.thunk = thunk
+        self.grammar = None
 
     def trace_repr(self):
         return "Lazy wrapper"
 
-    def parse(self, cursor, level = 0):
-        return self.thunk().parse(cursor, level + 1)
+    def nullable(self, seen = None):
+        return self.expand(lambda grammar, seen: grammar.nullable(seen), seen, False)
+
+    def fails_committed(self, seen = None):
+        return self.expand(lambda grammar, seen: grammar.fails_committed(seen), seen, False)
+
+    def first(self, seen = None):
+        return self.expand(lambda grammar, seen: grammar.first(seen), seen)
+
+    def certain_first(self, seen = None):
+        return self.expand(lambda grammar, seen: grammar.certain_first(seen), seen)
+
+    def single_token(self, seen = None):
+        # a grammar that refers back to itself isn't taken for a single token
+        return self.expand(lambda grammar, seen: grammar.single_token(seen), seen, None)
+
+    def expand(self, f, seen, recursive = First.NONE):
+        """
+        Returns `f(target, seen)` with this `Lazy` added to `seen` meanwhile,
+        or `recursive` if it's already being expanded further up; by default
+        no tokens at all, which adds nothing to what the expansion further up
+        will find.
+        """
+        if seen is None:
+            seen = set()
+        if self in seen:
+            return recursive
+        seen.add(self)
+        try:
+            return f(self.resolve(), seen)
+        finally:
+            seen.remove(self)
+
+    def __getstate__(self):
+        # pickled as the grammar it refers to, since the thunk can't be
+        state = Grammar.__getstate__(self)
+        state['grammar'] = self.resolve()
+        state['thunk'] = None
+        return state
+
+    def resolve(self):
+        "Returns the grammar produced by `thunk`, calling it only the first time."
+        if self.grammar is None:
+            self.grammar = self.thunk()
+        return self.grammar
+
+    def children(self):
+        return [self.resolve()]
+
+    def parse_tokens(self, tokens, index, level, state):
+        grammar = self.grammar
+        if grammar is None:
+            grammar = self.resolve()
+        return state.apply(grammar, tokens, index, level + 1)
+
+    def parse_steps(self, tokens, index, level, state):
+        grammar = self.grammar
+        if grammar is None:
+            grammar = self.resolve()
+        yield (yield (grammar, index, level + 1))
+
+    def compile_parser(self, compiler):
+        # the target may refer back to this Lazy, so this is registered
+        # with the compiler before the target is compiled.
+        target = []
+        def parse(tokens, index):
+            return target[0](tokens, index)
+        compiler.compiled[self] = parse
+        target.append(compiler.compile(self.resolve()))
+        return parse
+
+    def compile_recognizer(self, compiler):
+        return self.compile_parser(compiler)
 
     def rename(self, name):
         return Lazy(self.thunk, name)
@@ -150,9 +989,39 @@ class AnyToken(Grammar):
 
     def rename(self, name):
         return AnyToken(self.name)
+
+    def first(self, seen = None):
+        return First.ANY
+
+    def certain_first(self, seen = None):
+        return First.ANY
+
+    def single_token(self, seen = None):
+        return (First.ANY, None)
     
-    def parse_non_empty(self, cursor, level):
-        return (Result(cursor.head()), cursor.tail())
+    def parse_tokens(self, tokens, index, level, state):
+        return (Result(tokens[index]), index + 1)
+
+    def compile_parser(self, compiler):
+        if compiler.vocabulary is not None:
+            words = compiler.vocabulary.words
+            def parse(tokens, index):
+                if index < len(tokens):
+                    return (Result(words[tokens[index]]), index + 1)
+                else:
+                    return (None, index)
+            return parse
+        def parse(tokens, index):
+            if index < len(tokens):
+                return (Result(tokens[index]), index + 1)
+            else:
+                return (None, index)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        def recognize(tokens, index):
+            return index + 1 if index < len(tokens) else None
+        return recognize
 
 
 class Token(Grammar):
@@ -170,14 +1039,164 @@ class Token(Grammar):
 
     def rename(self, name):
         return Token(self.value, name)
+
+    def first(self, seen = None):
+        return First([self.value])
+
+    def certain_first(self, seen = None):
+        return First([self.value])
+
+    def single_token(self, seen = None):
+        return (First([self.value]), None)
     
-    def parse_non_empty(self, start, level):
-        if start.head() == self.value:
-            return (Result(start.head()), start.tail())
+    def parse_tokens(self, tokens, index, level, state):
+        head = tokens[index]
+        if head == self.value:
+            return (Result(head), index + 1)
         else:
-            return (False, start)
-        
-        
+            return (False, index)
+
+    def compile_parser(self, compiler):
+        value = self.value
+        if compiler.vocabulary is not None:
+            code = compiler.vocabulary.code(value)
+            def parse(tokens, index):
+                if index >= len(tokens):
+                    return (None, index)
+                elif tokens[index] == code:
+                    return (Result(value), index + 1)
+                else:
+                    return (False, index)
+            return parse
+        def parse(tokens, index):
+            if index >= len(tokens):
+                return (None, index)
+            elif tokens[index] == value:
+                return (Result(tokens[index]), index + 1)
+            else:
+                return (False, index)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        value = self.value
+        if compiler.vocabulary is not None:
+            value = compiler.vocabulary.code(value)
+        def recognize(tokens, index):
+            if index < len(tokens) and tokens[index] == value:
+                return index + 1
+            else:
+                return None
+        return recognize
+
+
+class Literal(Grammar):
+    """
+    Matches a given string at the current position of a text, for parsing
+    a string directly rather than a list of tokens, i.e. with the `Cursor`
+    on the string itself and the index an offset into it.
+    e.g. Literal("if") matches the "if" in "if x".
+    """
+
+    def __init__(self, value, name = None):
+        Grammar.__init__(self, name)
+        self.value = value
+
+    def trace_repr(self):
+        return "Literal(" + self.value + ")"
+
+    def rename(self, name):
+        return Literal(self.value, name)
+
+    def first(self, seen = None):
+        return First([self.value[:1]])
+
+    def certain_first(self, seen = None):
+        # a longer literal can fail on the characters after its first
+        if len(self.value) == 1:
+            return First([self.value])
+        else:
+            return First.NONE
+
+    def parse_tokens(self, tokens, index, level, state):
+        value = self.value
+        if value and tokens.startswith(value, index):
+            return (Result(value), index + len(value))
+        else:
+            return (False, index)
+
+    def compile_parser(self, compiler):
+        value = self.value
+        length = len(value)
+        def parse(tokens, index):
+            if index >= len(tokens):
+                return (None, index)
+            elif length and tokens.startswith(value, index):
+                return (Result(value), index + length)
+            else:
+                return (False, index)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        value = self.value
+        length = len(value)
+        def recognize(tokens, index):
+            if index < len(tokens) and length and tokens.startswith(value, index):
+                return index + length
+            else:
+                return None
+        return recognize
+
+
+class Regex(Grammar):
+    """
+    Matches a regular expression at the current position of a text, as for
+    `Literal`.  `Result.value` is the matched string.  A match of no characters
+    counts as no match, so `Regex` always moves the parse along.
+    e.g. Regex("[0-9]+") matches the "42" in "42 + 1".
+    """
+
+    def __init__(self, pattern, flags = 0, name = None):
+        Grammar.__init__(self, name)
+        self.regex = re.compile(pattern, flags)
+
+    def trace_repr(self):
+        return "Regex(" + self.regex.pattern + ")"
+
+    def rename(self, name):
+        return Regex(self.regex, name = name)
+
+    def parse_tokens(self, tokens, index, level, state):
+        match = self.regex.match(tokens, index)
+        if match and match.end() > index:
+            return (Result(match.group()), match.end())
+        else:
+            return (False, index)
+
+    def compile_parser(self, compiler):
+        match_at = self.regex.match
+        def parse(tokens, index):
+            if index >= len(tokens):
+                return (None, index)
+            match = match_at(tokens, index)
+            if match and match.end() > index:
+                return (Result(match.group()), match.end())
+            else:
+                return (False, index)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        match_at = self.regex.match
+        def recognize(tokens, index):
+            if index >= len(tokens):
+                return None
+            match = match_at(tokens, index)
+            if match and match.end() > index:
+                return match.end()
+            else:
+                return None
+        return recognize
+
+
 class AllOf(Grammar):
     """
     Matches an entire list of grammars in sequence.
@@ -188,6 +1207,12 @@ class AllOf(Grammar):
     def __init__(self, grammars, name = None):
         Grammar.__init__(self, name)
         self.grammars = grammars
+        # the position of the first grammar that commits to this match
+        self.commit_position = None
+        for (position, grammar) in enumerate(grammars):
+            if grammar.commits():
+                self.commit_position = position
+                break
 
     def trace_repr(self):
         return "AllOf(" + str(self.grammars) + ")"
@@ -195,28 +1220,104 @@ class AllOf(Grammar):
     def rename(self, name):
         return AllOf(self.grammars, name)
 
-    def parse_non_empty(self, start, level):
+    def children(self):
+        return list(self.grammars)
 
-        # a hack to let us modify a closure variable
-        class grammars: pass
-        grammars.val = Cursor(self.grammars)
+    def nullable(self, seen = None):
+        return bool(self.grammars) and all(grammar.nullable(seen) for grammar in self.grammars)
 
-        def parse_next(cursor):
-            if grammars.val.empty():
-                return (None, cursor)
-            else:
-                (result, end) = grammars.val.head().parse(cursor, level + 1)
-                if result:
-                    grammars.val = grammars.val.tail()
-                return (result, end)
-                
-        (results, end) = start.crawl_while(parse_next)
+    def fails_committed(self, seen = None):
+        if self.commit_position is not None and self.commit_position < len(self.grammars) - 1:
+            return True
+        return any(grammar.fails_committed(seen) for grammar in self.grammars)
+
+    def first(self, seen = None):
+        if self.grammars:
+            return self.grammars[0].first(seen)
+        else:
+            return First.NONE
 
-        if not (results and grammars.val.empty()):            
-            return (None, start)
+    def certain_first(self, seen = None):
+        if len(self.grammars) == 1:
+            return self.grammars[0].certain_first(seen)
+        else:
+            return First.NONE
+
+    def failure(self, position, result):
+        """
+        The result of this AllOf when the grammar at `position` fails with
+        `result`: `Commit.FAILED` if that's past a `Commit`, or it failed
+        past one of its own.
+        """
+        if result is Commit.FAILED or (self.commit_position is not None and
+                                       position > self.commit_position):
+            return Commit.FAILED
+        else:
+            return None
+
+    def parse_tokens(self, tokens, index, level, state):
+        results = []
+        end = index
+        for grammar in self.grammars:
+            (result, end) = state.apply(grammar, tokens, end, level + 1)
+            if not result:
+                return (self.failure(len(results), result), index)
+            results.append(result)
+        if not results:
+            return (None, index)
         else:
             return (Result.merge_all(results), end)
 
+    def parse_steps(self, tokens, index, level, state):
+        results = []
+        end = index
+        for grammar in self.grammars:
+            (result, end) = yield (grammar, end, level + 1)
+            if not result:
+                yield (self.failure(len(results), result), index)
+                return
+            results.append(result)
+        if not results:
+            yield (None, index)
+        else:
+            yield (Result.merge_all(results), end)
+
+    def compile_parser(self, compiler):
+        parsers = [compiler.compile(grammar) for grammar in self.grammars]
+        merge_all = Result.merge_all
+        failure = self.failure
+        def parse(tokens, index):
+            if not parsers:
+                return (None, index)
+            results = []
+            end = index
+            length = len(tokens)
+            for parser in parsers:
+                if end >= length:
+                    return (failure(len(results), None), index)
+                (result, end) = parser(tokens, end)
+                if not result:
+                    return (failure(len(results), result), index)
+                results.append(result)
+            return (merge_all(results), end)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        recognizers = [compiler.compile(grammar) for grammar in self.grammars]
+        failure = self.failure
+        failed = Commit.FAILED
+        def recognize(tokens, index):
+            if not recognizers:
+                return None
+            end = index
+            length = len(tokens)
+            for (position, recognizer) in enumerate(recognizers):
+                end = recognizer(tokens, end) if end < length else None
+                if end is None or end is failed:
+                    return failure(position, end)
+            return end
+        return recognize
+
 
 class OneOrMore(Grammar):
     """
@@ -232,45 +1333,375 @@ class OneOrMore(Grammar):
         """
         Grammar.__init__(self, name)        
         self.grammar = grammar
+        # the grammar's `single_token`, or False if it isn't one
+        self.single = None
+
+    def __getstate__(self):
+        # `single` may hold closures, and is quick to work out again
+        state = Grammar.__getstate__(self)
+        state['single'] = None
+        return state
 
     def trace_repr(self):
         return "OneOrMore(" + str(self.grammar) + ")"
 
     def rename(self, name):
         return OneOrMore(self.grammar, name)
-    
-    def parse_non_empty(self, start, level):
-        (results, end) = start.crawl_while(lambda c: self.grammar.parse(c, level + 1))
+
+    def children(self):
+        return [self.grammar]
+
+    def parse_stream(self, tokens, packrat = False, iterative = False):
+        "Yields each repetition's `Result` as it's parsed, see `Grammar.parse_stream`."
+        return self.grammar.parse_stream(tokens, packrat, iterative)
+
+    def nullable(self, seen = None):
+        return self.grammar.nullable(seen)
+
+    def first(self, seen = None):
+        return self.grammar.first(seen)
+
+    def certain_first(self, seen = None):
+        return self.grammar.certain_first(seen)
+
+    def finalize(self):
+        self.single = self.grammar.single_token() or False
+
+    def run(self, tokens, index, deferred = False, interned = None):
+        """
+        Matches a run of `grammar` in one loop, if it's a single token (see
+        `Grammar.single_token`) and `tokens` is a list, returning the same
+        `(result, end)` as parsing it one repeat at a time.  Returns None if
+        it can't, or if `deferred` and matching it would call a map's function.
+
+        For tokens interned with a `Vocabulary`, `interned` is the pair of
+        the `First` set of `single` as the tokens' numbers, and the
+        vocabulary's `words`.
+        """
+        if self.single is None:
+            self.finalize()
+        if not self.single or (interned is None and type(tokens) is not list):
+            return None
+        (first, convert) = self.single
+        if deferred and convert is not None:
+            return None
+        end = self.run_end(tokens, index, interned and interned[0])
+        if end is None:
+            return None
+        if interned is None:
+            values = tokens[index:end]
+        else:
+            words = interned[1]
+            values = [words[code] for code in tokens[index:end]]
+        if convert is None:
+            return (Result(values), end) if values else ([], index)
+        results = []
+        for value in values:
+            result = convert(value)
+            if not result:
+                return (Result.merge_all(results), index + len(results)) if results else ([], index)
+            results.append(result)
+        return (Result.merge_all(results), end) if results else ([], index)
+
+    def run_end(self, tokens, index, first = None):
+        """
+        Returns where the run of tokens in the `First` set of `single`, or
+        in `first` if given, starting at `index` ends, or None if a token is
+        unhashable.
+        """
+        if first is None:
+            first = self.single[0]
+        members = first.tokens
+        end = index
+        length = len(tokens)
+        try:
+            if not first.excluding:
+                while end < length and tokens[end] in members:
+                    end += 1
+            elif members:
+                while end < length and tokens[end] not in members:
+                    end += 1
+            else:
+                end = length
+        except TypeError:
+            # an unhashable token
+            return None
+        return end
+
+    def interned(self, vocabulary):
+        "Returns `interned` for `run` with tokens interned with `vocabulary`, if any."
+        if self.single is None:
+            self.finalize()
+        if vocabulary is None or not self.single:
+            return None
+        first = self.single[0]
+        return (First([vocabulary.code(token) for token in first.tokens], first.excluding),
+                vocabulary.words)
+
+    def parse_tokens(self, tokens, index, level, state):
+        if state.tracer is None:
+            run = self.run(tokens, index, state.deferred)
+            if run is not None:
+                if run[1] >= len(tokens):
+                    # in partial mode the run might go on in tokens not read yet
+                    state.end_of_input(run[1])
+                return run
+        results = []
+        end = index
+        while True:
+            (result, next) = state.apply(self.grammar, tokens, end, level + 1)
+            if not result:
+                break
+            results.append(result)
+            end = next
         if results:
-            cursor = end
+            return (Result.merge_all(results), end)
         else:
-            cursor = start
-        return (results and Result.merge_all(results), cursor)
+            return (results, index)
+
+    def parse_steps(self, tokens, index, level, state):
+        if state.tracer is None:
+            run = self.run(tokens, index, state.deferred)
+            if run is not None:
+                if run[1] >= len(tokens):
+                    state.end_of_input(run[1])
+                yield run
+                return
+        results = []
+        end = index
+        while True:
+            (result, next) = yield (self.grammar, end, level + 1)
+            if not result:
+                break
+            results.append(result)
+            end = next
+        if results:
+            yield (Result.merge_all(results), end)
+        else:
+            yield (results, index)
+
+    def compile_parser(self, compiler):
+        parser = compiler.compile(self.grammar)
+        merge_all = Result.merge_all
+        run = self.run
+        interned = self.interned(compiler.vocabulary)
+        def parse(tokens, index):
+            length = len(tokens)
+            if index >= length:
+                return (None, index)
+            outcome = run(tokens, index, False, interned)
+            if outcome is not None:
+                return outcome
+            results = []
+            end = index
+            while end < length:
+                (result, next) = parser(tokens, end)
+                if not result:
+                    break
+                results.append(result)
+                end = next
+            if results:
+                return (merge_all(results), end)
+            else:
+                return (results, index)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        recognizer = compiler.compile(self.grammar)
+        if self.single is None:
+            self.finalize()
+        # a run of single tokens matches whatever the maps on them return
+        run_end = self.run_end if self.single else None
+        interned = self.interned(compiler.vocabulary)
+        first = interned and interned[0]
+        failed = Commit.FAILED
+        def recognize(tokens, index):
+            length = len(tokens)
+            if index >= length:
+                return None
+            if run_end is not None and (first is not None or type(tokens) is list):
+                end = run_end(tokens, index, first)
+                if end is not None:
+                    return end if end > index else None
+            end = index
+            while end < length:
+                next = recognizer(tokens, end)
+                if next is None or next is failed:
+                    break
+                end = next
+            return end if end > index else None
+        return recognize
     
 
 class OneOf(Grammar):
-    "A disjunction: takes a number of grammars and finds the first one that matches."
+    """
+    A disjunction: takes a number of grammars and finds the first one that matches.
+
+    Rather than trying every grammar in turn, it only tries those whose `first`
+    set includes the token at the cursor, looking them up in a `dispatch` table
+    built the first time it parses (or when the grammar is frozen).
+    """
 
     def __init__(self, grammars, name = None):
         Grammar.__init__(self, name)        
         self.grammars = grammars
+        self.dispatch = None
 
     def trace_repr(self):
         return "OneOf(" + str(self.grammars) + ")"
 
     def rename(self, name):
         return OneOf(self.grammars, name)
-        
-    def parse_non_empty(self, start, level):
-        grammars = Cursor(self.grammars)
+
+    def children(self):
+        return list(self.grammars)
+
+    def nullable(self, seen = None):
+        return any(grammar.nullable(seen) for grammar in self.grammars)
+
+    def first(self, seen = None):
+        first = First.NONE
+        for grammar in self.grammars:
+            first = first.union(grammar.first(seen))
+        return first
+
+    def certain_first(self, seen = None):
+        first = First.NONE
+        for grammar in self.grammars:
+            first = first.union(grammar.certain_first(seen))
+            if grammar.fails_committed(seen):
+                # the alternatives after it aren't tried if it does
+                break
+        return first
+
+    def single_token(self, seen = None):
+        singles = [grammar.single_token(seen) for grammar in self.grammars]
+        if None in singles:
+            return None
+        first = First.NONE
+        for (alternative, _) in singles:
+            first = first.union(alternative)
+        if all(convert is None for (_, convert) in singles):
+            return (first, None)
+        def convert(token):
+            for (alternative, convert) in singles:
+                if token in alternative:
+                    result = convert(token) if convert else Result(token)
+                    if result:
+                        return result
+            return False
+        return (first, convert)
+
+    def finalize(self):
+        self.dispatch = self.dispatch_table()
+
+    def dispatch_table(self):
+        """
+        Returns a pair of:
+        1) a dict from each token mentioned in the grammars' `first` sets to
+           the grammars, in order, that can match starting with it, and
+        2) the grammars that can match starting with any other token.
+        """
+        firsts = [(grammar, grammar.first()) for grammar in self.grammars]
+        mentioned = set()
+        for (_, first) in firsts:
+            mentioned.update(first.tokens)
+        table = {}
+        for token in mentioned:
+            table[token] = [grammar for (grammar, first) in firsts if token in first]
+        others = [grammar for (grammar, first) in firsts if first.excluding]
+        return (table, others)
+
+    def alternatives(self, token):
+        "The grammars to try, in order, when the next token is `token`."
+        if self.dispatch is None:
+            self.dispatch = self.dispatch_table()
+        (table, others) = self.dispatch
+        try:
+            return table.get(token, others)
+        except TypeError:
+            # an unhashable token
+            return self.grammars
+
+    def parse_tokens(self, tokens, index, level, state):
         result = False
-        end = start
-        while grammars.not_empty() and not result:
-            (result, end) = grammars.head().parse(start, level + 1)
-            if not result:
-                grammars = grammars.tail()
+        end = index
+        for grammar in self.alternatives(tokens[index]):
+            (result, end) = state.apply(grammar, tokens, index, level + 1)
+            if result:
+                break
+            elif result is Commit.FAILED:
+                return (None, end)
         return (result, end)
 
+    def parse_steps(self, tokens, index, level, state):
+        result = False
+        end = index
+        for grammar in self.alternatives(tokens[index]):
+            (result, end) = yield (grammar, index, level + 1)
+            if result:
+                break
+            elif result is Commit.FAILED:
+                result = None
+                break
+        yield (result, end)
+
+    def compile_table(self, compiler):
+        """
+        Returns the `dispatch_table` with each grammar compiled, as a triple
+        of all the grammars, the table, and the grammars for other tokens.
+        """
+        (table, others) = self.dispatch_table()
+        def compile_all(grammars):
+            return [compiler.compile(grammar) for grammar in grammars]
+        vocabulary = compiler.vocabulary
+        for token in list(table):
+            if vocabulary is not None:
+                table[vocabulary.code(token)] = compile_all(table.pop(token))
+            else:
+                table[token] = compile_all(table[token])
+        return (compile_all(self.grammars), table, compile_all(others))
+
+    def compile_parser(self, compiler):
+        (parsers, table, others) = self.compile_table(compiler)
+        failed = Commit.FAILED
+        def parse(tokens, index):
+            if index >= len(tokens):
+                return (None, index)
+            try:
+                candidates = table.get(tokens[index], others)
+            except TypeError:
+                candidates = parsers
+            result = False
+            end = index
+            for parser in candidates:
+                (result, end) = parser(tokens, index)
+                if result:
+                    break
+                elif result is failed:
+                    return (None, end)
+            return (result, end)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        (recognizers, table, others) = self.compile_table(compiler)
+        failed = Commit.FAILED
+        def recognize(tokens, index):
+            if index >= len(tokens):
+                return None
+            try:
+                candidates = table.get(tokens[index], others)
+            except TypeError:
+                candidates = recognizers
+            for recognizer in candidates:
+                end = recognizer(tokens, index)
+                if end is failed:
+                    return None
+                elif end is not None:
+                    return end
+            return None
+        return recognize
+
     
 class Unless(Grammar):
     """
@@ -288,20 +1719,186 @@ class Unless(Grammar):
     def rename(self, name):
         return Unless(self.unless, self.grammar, name)
 
-    def parse_non_empty(self, start, level):
-        (unless, _) = self.unless.parse(start, level + 1)
+    def children(self):
+        return [self.unless, self.grammar]
+
+    def nullable(self, seen = None):
+        return self.grammar.nullable(seen)
+
+    def fails_committed(self, seen = None):
+        return self.grammar.fails_committed(seen)
+
+    def first(self, seen = None):
+        return self.grammar.first(seen).minus(self.unless.certain_first(seen))
+
+    def certain_first(self, seen = None):
+        return self.grammar.certain_first(seen).minus(self.unless.first(seen))
+
+    def single_token(self, seen = None):
+        unless = self.unless.single_token(seen)
+        single = self.grammar.single_token(seen)
+        if unless is None or unless[1] is not None or single is None:
+            return None
+        return (single[0].minus(unless[0]), single[1])
+
+    def parse_tokens(self, tokens, index, level, state):
+        (unless, _) = state.apply(self.unless, tokens, index, level + 1)
         if unless:
-            return (False, start)
+            return (False, index)
         else:
-            return self.grammar.parse(start, level + 1)
+            return state.apply(self.grammar, tokens, index, level + 1)
+
+    def parse_steps(self, tokens, index, level, state):
+        (unless, _) = yield (self.unless, index, level + 1)
+        if unless:
+            yield (False, index)
+        else:
+            yield (yield (self.grammar, index, level + 1))
+
+    def compile_parser(self, compiler):
+        unless = compiler.compile(self.unless)
+        parser = compiler.compile(self.grammar)
+        def parse(tokens, index):
+            if index >= len(tokens):
+                return (None, index)
+            elif unless(tokens, index)[0]:
+                return (False, index)
+            else:
+                return parser(tokens, index)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        unless = compiler.compile(self.unless)
+        recognizer = compiler.compile(self.grammar)
+        failed = Commit.FAILED
+        def recognize(tokens, index):
+            if index >= len(tokens):
+                return None
+            end = unless(tokens, index)
+            if end is not None and end is not failed:
+                return None
+            else:
+                return recognizer(tokens, index)
+        return recognize
+
+
+class Packrat(Grammar):
+    """
+    Parses `grammar` in packrat mode, the same as passing `packrat = True`
+    to `parse`, but fixed to this point in the grammar tree, e.g. the root.
+    The memo table lives only as long as each parse of `grammar`.
+    """
+    def __init__(self, grammar, name = None):
+        Grammar.__init__(self, name)
+        self.grammar = grammar
+
+    def trace_repr(self):
+        return "Packrat(" + str(self.grammar) + ")"
+
+    def rename(self, name):
+        return Packrat(self.grammar, name)
+
+    def children(self):
+        return [self.grammar]
+
+    def nullable(self, seen = None):
+        return self.grammar.nullable(seen)
+
+    def fails_committed(self, seen = None):
+        return self.grammar.fails_committed(seen)
+
+    def first(self, seen = None):
+        return self.grammar.first(seen)
+
+    def parse_tokens(self, tokens, index, level, state):
+        if state.memo is None:
+            state = state.memoized()
+        return state.apply(self.grammar, tokens, index, level + 1)
+
+    def parse_steps(self, tokens, index, level, state):
+        if state.memo is None:
+            # the memo table belongs to a new state, and so to a new stack.
+            yield self.parse_tokens(tokens, index, level, state)
+        else:
+            yield (yield (self.grammar, index, level + 1))
+
+
+class Commit(Grammar):
+    """
+    Parses `grammar` as is, but as one of the grammars in an `AllOf` it
+    commits the AllOf to matching: if a grammar after it then fails, the
+    AllOf fails with `Commit.FAILED`, and a `OneOf` that gets that from one
+    of its alternatives fails without trying the ones after it.  An AllOf
+    that gets it from a nested AllOf fails with it too.
+    """
+
+    def __init__(self, grammar, name = None):
+        Grammar.__init__(self, name)
+        self.grammar = grammar
+
+    def trace_repr(self):
+        return "Commit(" + str(self.grammar) + ")"
+
+    def rename(self, name):
+        return Commit(self.grammar, name)
+
+    def children(self):
+        return [self.grammar]
+
+    def nullable(self, seen = None):
+        return self.grammar.nullable(seen)
+
+    def fails_committed(self, seen = None):
+        return self.grammar.fails_committed(seen)
+
+    def first(self, seen = None):
+        return self.grammar.first(seen)
+
+    def certain_first(self, seen = None):
+        return self.grammar.certain_first(seen)
+
+    def commits(self):
+        return True
+
+    def single_token(self, seen = None):
+        return self.grammar.single_token(seen)
+
+    def parse_tokens(self, tokens, index, level, state):
+        return state.apply(self.grammar, tokens, index, level + 1)
+
+    def parse_steps(self, tokens, index, level, state):
+        yield (yield (self.grammar, index, level + 1))
+
+    def compile_parser(self, compiler):
+        return compiler.compile(self.grammar)
+
+    def compile_recognizer(self, compiler):
+        return compiler.compile(self.grammar)
+
+
+class Committed(object):
+    "The falsy result of an `AllOf` that failed after a `Commit`."
+
+    def __nonzero__(self):
+        return False
+
+    __bool__ = __nonzero__
+
+    def __repr__(self):
+        return "Commit.FAILED"
+
+Commit.FAILED = Committed()
+
 
-    
 
 #############################################################################
 # Grammars that transform a matched Result as it returns back up the stack.
 
 class MapResult(Grammar):
 
+    # whether `f` needs to see the values of deferred maps, see `Deferred`.
+    forces = True
+
     def __init__(self, f, grammar, name = None):
         Grammar.__init__(self, name)
         self.f = f
@@ -310,12 +1907,73 @@ class MapResult(Grammar):
     def trace_repr(self):
         return "MapResult(" + str(self.grammar) + ")"
 
+    def __getstate__(self):
+        # python 2 can't pickle methods, so when `f` is one of this grammar's
+        # own, as for `Keep` and `Clear`, it's pickled by name.
+        state = Grammar.__getstate__(self)
+        if getattr(self.f, '__self__', None) is self:
+            state['f'] = self.f.__name__
+        return state
+
+    def __setstate__(self, state):
+        Grammar.__setstate__(self, state)
+        if isinstance(self.f, str):
+            self.f = getattr(self, self.f)
+
     def rename(self, name):
         return MapResult(self.f, self.grammar.rename(name), "Map of " + name)
 
-    def parse_non_empty(self, start, level):
-        (result, end) = self.grammar.parse(start, level + 1)
-        return (result and self.f(result), end)
+    def children(self):
+        return [self.grammar]
+
+    def nullable(self, seen = None):
+        return self.grammar.nullable(seen)
+
+    def fails_committed(self, seen = None):
+        return self.grammar.fails_committed(seen)
+
+    def first(self, seen = None):
+        return self.grammar.first(seen)
+
+    def commits(self):
+        return self.grammar.commits()
+
+    def single_token(self, seen = None):
+        single = self.grammar.single_token(seen)
+        if single is None:
+            return None
+        (first, convert) = single
+        f = self.f
+        def map_result(token):
+            result = convert(token) if convert else Result(token)
+            return result and f(result)
+        return (first, map_result)
+
+    def parse_tokens(self, tokens, index, level, state):
+        (result, end) = state.apply(self.grammar, tokens, index, level + 1)
+        return (self.map_result(result, state), end)
+
+    def parse_steps(self, tokens, index, level, state):
+        (result, end) = yield (self.grammar, index, level + 1)
+        yield (self.map_result(result, state), end)
+
+    def map_result(self, result, state):
+        if result and state.deferred and self.forces:
+            result = result.forced()
+        return result and self.f(result)
+
+    def compile_parser(self, compiler):
+        parser = compiler.compile(self.grammar)
+        f = self.f
+        def parse(tokens, index):
+            if index >= len(tokens):
+                return (None, index)
+            (result, end) = parser(tokens, index)
+            return (result and f(result), end)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        return compiler.compile(self.grammar)
 
     
 class Map(Grammar):
@@ -335,18 +1993,71 @@ class Map(Grammar):
     def rename(self, name):
         return Map(self.f, self.grammar.rename(name), "Map of " + name)
 
+    def children(self):
+        return [self.grammar]
+
+    def nullable(self, seen = None):
+        return self.grammar.nullable(seen)
+
+    def fails_committed(self, seen = None):
+        return self.grammar.fails_committed(seen)
+
+    def first(self, seen = None):
+        return self.grammar.first(seen)
+
+    def commits(self):
+        return self.grammar.commits()
+
+    def single_token(self, seen = None):
+        single = self.grammar.single_token(seen)
+        if single is None:
+            return None
+        (first, convert) = single
+        f = self.f
+        def map(token):
+            result = convert(token) if convert else Result(token)
+            return (result and result.value and
+                    Result(f(result.value, result.keeps), result.kept))
+        return (first, map)
+
     # TODO: impl. this as a subclass of MapResult.  this caused a bug before.
     
-    def parse_non_empty(self, start, level):
-        (result, end) = self.grammar.parse(start, level + 1)
-        new_result = (result and result.value and
-                      Result(self.f(result.value, result.keeps), result.keeps))
-        return (new_result, end)
+    def parse_tokens(self, tokens, index, level, state):
+        (result, end) = state.apply(self.grammar, tokens, index, level + 1)
+        return (self.map_result(result, state), end)
+
+    def parse_steps(self, tokens, index, level, state):
+        (result, end) = yield (self.grammar, index, level + 1)
+        yield (self.map_result(result, state), end)
+
+    def map_result(self, result, state):
+        if not (result and result.value):
+            return result and result.value
+        elif state.deferred:
+            return Result(Deferred(self.f, result), result.kept)
+        else:
+            return Result(self.f(result.value, result.keeps), result.kept)
+
+    def compile_parser(self, compiler):
+        parser = compiler.compile(self.grammar)
+        f = self.f
+        def parse(tokens, index):
+            if index >= len(tokens):
+                return (None, index)
+            (result, end) = parser(tokens, index)
+            return ((result and result.value and
+                     Result(f(result.value, result.keeps), result.kept)), end)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        return compiler.compile(self.grammar)
     
     
 class Keep(MapResult):
     "Maps the Result to one with the result's value in the `keeps` dictionary."
 
+    forces = False
+
     def __init__(self, key, grammar, name = None):        
         MapResult.__init__(self, self.add_key, grammar, name)
         self.key = key
@@ -358,27 +2069,478 @@ class Keep(MapResult):
         return Keep(self.key, self.grammar.rename(name), name)
     
     def add_key(self, result):
-        new_keeps = result.keeps.copy()
-        if self.key in new_keeps:
+        kept = result.kept
+        if kept is None:
+            return Result(result.value, Keeps(items = { self.key: result.value }))
+        elif self.key in kept:
             raise Exception("Keep: adding duplicate key '" + self.key + "'")
-        new_keeps[self.key] = result.value
-        return Result(result.value, new_keeps)
+        else:
+            return Result(result.value, Keeps((kept,), { self.key: result.value }))
 
 
 class Clear(MapResult):
     "Clears the Result's `keeps` dictionary before it returns further up the stack."
 
+    forces = False
+
     def __init__(self, grammar, name = None):
-        MapResult.__init__(self, lambda result: Result(result.value), grammar, name)
+        MapResult.__init__(self, self.clear_keeps, grammar, name)
 
     def trace_repr(self):
         return "Clear(" + str(self.grammar) + ")"
 
     def rename(self, name):
         return Clear(self.grammar, name)
-        
 
+    def clear_keeps(self, result):
+        return Result(result.value)
 
-        
-    
-    
+
+#############################################################################
+# Compiling a grammar tree into a parser made of closures.
+
+def compile(root, vocabulary = None):
+    """
+    Compiles the grammar tree at `root` into a `Compiled` grammar that parses
+    exactly as `root` does, but faster: each grammar in the tree becomes a
+    closure that calls its sub-grammars' closures directly over a list of
+    tokens and an index, without going through `ParseState`, `Cursor` or
+    tracing, and with every `Lazy` resolved once, up front.
+
+    Given a `Vocabulary`, the compiled grammar parses tokens interned with
+    it rather than the tokens themselves, see `Vocabulary.intern`.
+    """
+    return Compiled(root, Compiler(vocabulary).compile(root), vocabulary)
+
+
+class Compiler:
+    """
+    Compiles each grammar in a tree once, so shared and recursive grammars are compiled once.
+    With `recognize`, compiles them into recognizers, see `Grammar.compile_recognizer`.
+    """
+
+    def __init__(self, vocabulary = None, recognize = False):
+        self.compiled = {}
+        self.vocabulary = vocabulary
+        self.recognize = recognize
+
+    def no_vocabulary(self, grammar):
+        """
+        Raises if this compiler has a `Vocabulary`, for `grammar` to call
+        when it can't parse tokens interned with one, e.g. when it's compiled
+        to parse through `ParseState`.
+        """
+        if self.vocabulary is not None:
+            raise Exception("Compiler: " + repr(grammar) + " can't parse tokens interned "
+                            "with a Vocabulary")
+
+    def compile(self, grammar):
+        parser = self.compiled.get(grammar)
+        if parser is None:
+            if self.recognize:
+                parser = self.compiled[grammar] = grammar.compile_recognizer(self)
+            else:
+                parser = self.compiled[grammar] = grammar.compile_parser(self)
+        return parser
+
+
+class Compiled(Grammar):
+    """
+    A grammar compiled by `compile`.  Parses the same as the grammar it was
+    compiled from, except that it ignores `Grammar.trace` and does not run in
+    packrat or iterative mode unless asked to by `parse`, in which case it
+    parses with the original grammar.
+    """
+
+    def __init__(self, grammar, parser, vocabulary = None, name = None):
+        Grammar.__init__(self, name)
+        self.grammar = grammar
+        self.parser = parser
+        self.vocabulary = vocabulary
+
+    def trace_repr(self):
+        return "Compiled(" + str(self.grammar) + ")"
+
+    def __getstate__(self):
+        return (self.name, self.grammar, self.vocabulary)
+
+    def __setstate__(self, state):
+        (name, grammar, vocabulary) = state
+        Compiled.__init__(self, grammar, Compiler(vocabulary).compile(grammar), vocabulary, name)
+
+    def rename(self, name):
+        return Compiled(self.grammar, self.parser, self.vocabulary, name)
+
+    def children(self):
+        return [self.grammar]
+
+    def nullable(self, seen = None):
+        return self.grammar.nullable(seen)
+
+    def fails_committed(self, seen = None):
+        return self.grammar.fails_committed(seen)
+
+    def first(self, seen = None):
+        return self.grammar.first(seen)
+
+    def parse(self, cursor, level = 0, packrat = False, iterative = False, deferred = False,
+              profile = None):
+        if packrat or iterative or deferred or profile is not None:
+            self.no_vocabulary()
+            return self.grammar.parse(cursor, level, packrat, iterative, deferred, profile)
+        (result, end) = self.parser(cursor._list, cursor.index)
+        return (result, cursor.at(end))
+
+    def recognize(self, cursor):
+        if self.recognizer is None:
+            self.recognizer = Compiler(self.vocabulary, recognize = True).compile(self.grammar)
+        return Grammar.recognize(self, cursor)
+
+    def parse_tokens(self, tokens, index, level, state):
+        if not state.plain:
+            self.no_vocabulary()
+            return state.apply(self.grammar, tokens, index, level + 1)
+        return self.parser(tokens, index)
+
+    def parse_steps(self, tokens, index, level, state):
+        self.no_vocabulary()
+        yield (yield (self.grammar, index, level + 1))
+
+    def no_vocabulary(self):
+        "Raises if the grammar this was compiled from would be given interned tokens."
+        if self.vocabulary is not None:
+            raise Exception("Compiled: only the compiled parser parses interned tokens")
+
+    def compile_parser(self, compiler):
+        # compiled again for a compiler with another vocabulary
+        if compiler.vocabulary is not self.vocabulary:
+            return compiler.compile(self.grammar)
+        return self.parser
+
+    def compile_recognizer(self, compiler):
+        return compiler.compile(self.grammar)
+
+
+class Vocabulary:
+    """
+    Numbers the distinct tokens it's given, so a list of tokens can be held
+    as an `array` of small integers, and a grammar compiled with it compares
+    those integers rather than the tokens.  `words` is the tokens by number.
+    """
+
+    def __init__(self, words = ()):
+        self.words = []
+        self.codes = {}
+        for word in words:
+            self.code(word)
+
+    def code(self, word):
+        "Returns the number of `word`, numbering it if it's new."
+        code = self.codes.get(word)
+        if code is None:
+            code = self.codes[word] = len(self.words)
+            self.words.append(word)
+        return code
+
+    def intern(self, tokens):
+        """
+        Returns `tokens` as an `array('i')` of their numbers, for a `Cursor` to be
+        created on and parsed by a grammar compiled with this vocabulary.
+        """
+        return array('i', map(self.code, tokens))
+
+
+#############################################################################
+# Left-factoring the alternatives of a grammar tree.
+
+def factor(root):
+    """
+    Rewrites each `OneOf` in the grammar graph under `root` so that a run of
+    alternatives that start with the same grammars parses them only once: the
+    run becomes a `Factored` grammar that parses the shared prefix, then
+    tries what follows it in each alternative in turn.  Returns `root`.
+
+    An alternative can be an `AllOf`, or any other grammar taken as an AllOf
+    of just itself, under any number of `map`s, `mapResult`s and `keep`s,
+    which the Factored applies to the match just as they would have.  Every
+    `Lazy` is followed, and the prefix is made of grammars that are the same
+    or are `Token`s or `Literal`s of the same value.  An AllOf with a `Commit`
+    in it is left as it is.
+
+    The OneOfs are changed in place, so factor a grammar before compiling it.
+    Its results are the same, since a grammar parsed at the same index always
+    gives the same result, but a `map` or `mapResult` in the prefix is called
+    once rather than once per alternative.
+    """
+    seen = set([root])
+    pending = [root]
+    while pending:
+        grammar = pending.pop()
+        if isinstance(grammar, OneOf):
+            factored = factor_alternatives(grammar.grammars)
+            if len(factored) < len(grammar.grammars):
+                grammar.grammars = factored
+                grammar.dispatch = None
+        for child in grammar.children():
+            if child not in seen:
+                seen.add(child)
+                pending.append(child)
+    return root
+
+
+def factor_alternatives(grammars):
+    "Returns the alternatives `grammars` with each run of them that share a prefix `Factored`."
+    branches = [Branch.of(grammar) for grammar in grammars]
+    factored = []
+    start = 0
+    while start < len(grammars):
+        prefix = branches[start] and branches[start].grammars
+        stop = start + 1
+        while prefix and stop < len(grammars) and branches[stop]:
+            shared = branches[stop].shared(prefix)
+            if not shared:
+                break
+            prefix = prefix[:shared]
+            stop += 1
+        if stop - start < 2:
+            factored.append(grammars[start])
+        else:
+            factored.append(Factored(prefix, [branch.after(len(prefix))
+                                              for branch in branches[start:stop]]))
+        start = stop
+    return factored
+
+
+def same(grammar, other):
+    "Returns true if `grammar` and `other` always match the same way, following `Lazy`s."
+    (grammar, other) = (resolved(grammar), resolved(other))
+    return (grammar is other or
+            (grammar.__class__ is other.__class__ and isinstance(grammar, (Token, Literal)) and
+             grammar.value == other.value))
+
+
+def resolved(grammar):
+    "The grammar a `Lazy` refers to, through any number of them."
+    seen = set()
+    while isinstance(grammar, Lazy) and grammar not in seen:
+        seen.add(grammar)
+        grammar = grammar.resolve()
+    return grammar
+
+
+class Branch:
+    """
+    An alternative of a `OneOf` as `factor` takes it apart: the `grammars`
+    it parses in sequence, then the `wrappers`, the `Map`s and `MapResult`s
+    around them, innermost first.  If it isn't an `AllOf`, `bare` is true and
+    its one grammar's `Result` is used as it is, not in a list.
+    """
+
+    def __init__(self, grammars, wrappers, bare):
+        self.grammars = grammars
+        self.wrappers = wrappers
+        self.bare = bare
+
+    @staticmethod
+    def of(grammar):
+        "Returns the `Branch` of the alternative `grammar`, or None if it can't be factored."
+        wrappers = []
+        while True:
+            grammar = resolved(grammar)
+            if not isinstance(grammar, (Map, MapResult)):
+                break
+            wrappers.insert(0, grammar)
+            grammar = grammar.grammar
+        if not isinstance(grammar, AllOf):
+            return Branch([grammar], wrappers, True)
+        elif grammar.grammars and grammar.commit_position is None:
+            return Branch(grammar.grammars, wrappers, False)
+        else:
+            return None
+
+    def shared(self, prefix):
+        "Returns how many of the grammars at the start of `prefix` this branch starts with too."
+        length = 0
+        for (grammar, other) in zip(prefix, self.grammars):
+            if not same(grammar, other):
+                break
+            length += 1
+        return length
+
+    def after(self, length):
+        "Returns this branch with its first `length` grammars left out, for a `Factored`."
+        return Branch(self.grammars[length:], self.wrappers, self.bare)
+
+    def complete(self, results, state):
+        "Returns the `Result` of the alternative from the results of all its grammars."
+        result = results[0] if self.bare else Result.merge_all(results)
+        for wrapper in self.wrappers:
+            result = wrapper.map_result(result, state)
+        return result
+
+
+class Factored(Grammar):
+    """
+    A run of alternatives of a `OneOf` that start with the same grammars,
+    made by `factor`: parses the `prefix` once, then each `Branch` of
+    `branches` after it in turn, and matches as the first alternative whose
+    branch matches would have.
+    """
+
+    def __init__(self, prefix, branches, name = None):
+        Grammar.__init__(self, name)
+        self.prefix = prefix
+        self.branches = branches
+
+    def trace_repr(self):
+        return ("Factored(" + str(self.prefix) + ", " +
+                str([branch.grammars for branch in self.branches]) + ")")
+
+    def rename(self, name):
+        return Factored(self.prefix, self.branches, name)
+
+    def children(self):
+        children = list(self.prefix)
+        for branch in self.branches:
+            children.extend(branch.grammars)
+        return children
+
+    def nullable(self, seen = None):
+        return (all(grammar.nullable(seen) for grammar in self.prefix) and
+                any(all(grammar.nullable(seen) for grammar in branch.grammars)
+                    for branch in self.branches))
+
+    def fails_committed(self, seen = None):
+        return any(grammar.fails_committed(seen) for grammar in self.children())
+
+    def first(self, seen = None):
+        return self.prefix[0].first(seen)
+
+    def parse_tokens(self, tokens, index, level, state):
+        results = []
+        end = index
+        for grammar in self.prefix:
+            (result, end) = state.apply(grammar, tokens, end, level + 1)
+            if not result:
+                return (Commit.FAILED if result is Commit.FAILED else None, index)
+            results.append(result)
+        prefix_end = end
+        for branch in self.branches:
+            matched = list(results)
+            end = prefix_end
+            for grammar in branch.grammars:
+                (result, end) = state.apply(grammar, tokens, end, level + 1)
+                if not result:
+                    break
+                matched.append(result)
+            else:
+                result = branch.complete(matched, state)
+            if result:
+                return (result, end)
+            elif result is Commit.FAILED:
+                return (result, index)
+        return (None, index)
+
+    def parse_steps(self, tokens, index, level, state):
+        results = []
+        end = index
+        for grammar in self.prefix:
+            (result, end) = yield (grammar, end, level + 1)
+            if not result:
+                yield (Commit.FAILED if result is Commit.FAILED else None, index)
+                return
+            results.append(result)
+        prefix_end = end
+        for branch in self.branches:
+            matched = list(results)
+            end = prefix_end
+            for grammar in branch.grammars:
+                (result, end) = yield (grammar, end, level + 1)
+                if not result:
+                    break
+                matched.append(result)
+            else:
+                result = branch.complete(matched, state)
+            if result:
+                yield (result, end)
+                return
+            elif result is Commit.FAILED:
+                yield (result, index)
+                return
+        yield (None, index)
+
+    def compile_parser(self, compiler):
+        prefix = [compiler.compile(grammar) for grammar in self.prefix]
+        branches = [(branch, [compiler.compile(grammar) for grammar in branch.grammars])
+                    for branch in self.branches]
+        failed = Commit.FAILED
+        # the maps are applied as in a plain parse
+        state = ParseState()
+        def parse_all(parsers, results, tokens, end):
+            length = len(tokens)
+            for parser in parsers:
+                if end >= length:
+                    return (None, end)
+                (result, end) = parser(tokens, end)
+                if not result:
+                    return (result, end)
+                results.append(result)
+            return (True, end)
+        def parse(tokens, index):
+            results = []
+            (result, prefix_end) = parse_all(prefix, results, tokens, index)
+            if not result:
+                return (failed if result is failed else None, index)
+            for (branch, parsers) in branches:
+                matched = list(results)
+                (result, end) = parse_all(parsers, matched, tokens, prefix_end)
+                if result:
+                    result = branch.complete(matched, state)
+                if result:
+                    return (result, end)
+                elif result is failed:
+                    return (result, index)
+            return (None, index)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        prefix = [compiler.compile(grammar) for grammar in self.prefix]
+        branches = [[compiler.compile(grammar) for grammar in branch.grammars]
+                    for branch in self.branches]
+        failed = Commit.FAILED
+        def recognize_all(recognizers, tokens, end):
+            length = len(tokens)
+            for recognizer in recognizers:
+                end = recognizer(tokens, end) if end < length else None
+                if end is None or end is failed:
+                    break
+            return end
+        def recognize(tokens, index):
+            end = recognize_all(prefix, tokens, index)
+            if end is None or end is failed:
+                return end
+            for recognizers in branches:
+                branch_end = recognize_all(recognizers, tokens, end)
+                if branch_end is not None:
+                    return branch_end
+            return None
+        return recognize
+
+
+#############################################################################
+# Saving a grammar tree, to load it again without building it.
+
+def dump(root, file):
+    """
+    Writes the grammar tree at `root` to the binary `file`, with `pickle`, for
+    `load` to read back.  Each `Lazy` is written as the grammar it refers to.
+    The functions given to `map` and `mapResult` are written as the module
+    and name where they're defined, so they can't be lambdas or nested
+    functions, and `load` imports their modules.
+    """
+    pickle.dump(root.freeze(), file, pickle.HIGHEST_PROTOCOL)
+
+
+def load(file):
+    "Reads a grammar tree written by `dump` from the binary `file`."
+    return pickle.load(file)
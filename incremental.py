@@ -0,0 +1,110 @@
+from cursor import Cursor
+from grammar import ParseState, LeftRecursion
+
+# Reparses a list of tokens after an edit, reusing what the packrat memo table
+# recorded about the parts of the list the edit didn't touch.
+
+
+class IncrementalParse:
+    """
+    Parses `tokens` with `grammar` in packrat mode, keeping the memo table
+    afterwards, so that after an `edit` of the tokens only the grammars
+    whose parse looked at the edited tokens are parsed again.  The result
+    is the same as parsing the edited tokens from scratch.
+
+    A grammar's parse is taken to have looked at every token up to and
+    including the one it ended at, and any a sub-grammar looked at.  A
+    grammar of your own that looks further ahead than that without parsing
+    a sub-grammar there, as a `Regex` can, may be wrongly reused.
+    """
+
+    def __init__(self, grammar, tokens):
+        self.grammar = grammar
+        self.tokens = list(tokens)
+        self.state = TrackingState()
+
+    def parse(self):
+        "Returns the `(result, end)` of parsing the tokens, as `Grammar.parse` would."
+        (result, end) = self.state.apply(self.grammar, self.tokens, 0, 0)
+        return (result, Cursor(self.tokens, end))
+
+    def edit(self, start, stop, tokens):
+        """
+        Replaces the tokens from `start` up to `stop` with `tokens`, and
+        returns the `(result, end)` of parsing the edited tokens.
+        """
+        self.tokens[start:stop] = tokens
+        self.state = self.state.edited(start, stop, len(tokens) - (stop - start))
+        return self.parse()
+
+
+class TrackingState(ParseState):
+    """
+    A packrat `ParseState` that also records in `reaches`, for each grammar's
+    entry in the memo table, the last index its parse looked at, so that the
+    entries an edit doesn't affect can be kept (see `edited`).  `reach` is
+    the last index looked at by the parse in progress.
+
+    `active` holds the grammars being parsed, by index.  A grammar parsed
+    at an index where it's already active is left-recursive there, and the
+    index goes in `recursive`: while the recursion is grown, the entries at
+    that index depend on its final result, so each is taken to have looked
+    as far as any entry there did.
+    """
+
+    def __init__(self):
+        ParseState.__init__(self, packrat = True)
+        self.reaches = {}
+        self.reach = -1
+        self.active = set()
+        self.recursive = set()
+        self.apply = self.apply_tracked
+
+    def apply_tracked(self, grammar, tokens, index, level):
+        key = (grammar, index)
+        if key in self.active:
+            self.recursive.add(index)
+            return self.apply_memo(grammar, tokens, index, level)
+        outer = self.reach
+        self.reach = index
+        self.active.add(key)
+        try:
+            outcome = self.apply_memo(grammar, tokens, index, level)
+        finally:
+            self.active.remove(key)
+        at_index = self.reaches.get(index)
+        if at_index is None:
+            at_index = self.reaches[index] = {}
+        reach = max(self.reach, outcome[1], at_index.get(grammar, -1))
+        at_index[grammar] = reach
+        self.reach = max(outer, reach)
+        return outcome
+
+    def edited(self, start, stop, shift):
+        """
+        Returns a new state with the memo entries of this one that are still
+        good after the tokens from `start` up to `stop` are replaced, moving
+        `shift` places along those that come after them.
+        """
+        for index in self.recursive:
+            reaches = self.reaches[index]
+            reach = max(reaches.values())
+            for grammar in reaches:
+                reaches[grammar] = reach
+        state = TrackingState()
+        for (index, at_index) in self.memo.items():
+            reaches = self.reaches.get(index, {})
+            if index >= stop:
+                moved = dict((grammar, (outcome[0], outcome[1] + shift))
+                             for (grammar, outcome) in at_index.items()
+                             if not isinstance(outcome, LeftRecursion) and grammar in reaches)
+                state.memo[index + shift] = moved
+                state.reaches[index + shift] = dict((grammar, reaches[grammar] + shift)
+                                                    for grammar in moved)
+            elif index < start:
+                kept = dict((grammar, outcome) for (grammar, outcome) in at_index.items()
+                            if not isinstance(outcome, LeftRecursion) and
+                            reaches.get(grammar, start) < start)
+                state.memo[index] = kept
+                state.reaches[index] = dict((grammar, reaches[grammar]) for grammar in kept)
+        return state
@@ -0,0 +1,149 @@
+import re
+from array import array
+from grammar import Grammar, Result
+
+# Splits a string into tokens for a Grammar to parse, with one regular expression
+# made of all the rules for the different kinds of token, so the whole string is
+# scanned in a single pass of python's regex engine.
+
+
+class Lexer:
+    """
+    Turns a string into tokens using a list of `(name, pattern)` rules, each
+    a regular expression for one kind of token.  At each point in the string
+    the first rule that matches wins, so list keywords before identifiers.
+    Tokens matched by the rules named in `skip`, such as whitespace, are
+    dropped.  A character that no rule matches raises an exception.
+    """
+
+    def __init__(self, rules, skip = ()):
+        self.names = [name for (name, _) in rules]
+        self.ids = dict((name, id) for (id, name) in enumerate(self.names))
+        for name in skip:
+            if name not in self.ids:
+                raise Exception("Lexer: no rule named '" + name + "' to skip")
+        self.skip = frozenset(skip)
+        # the last alternative catches any character the rules don't
+        self.pattern = re.compile("|".join(["(?P<" + name + ">" + pattern + ")"
+                                            for (name, pattern) in rules] +
+                                           ["(?P<_error>.)"]),
+                                  re.DOTALL)
+
+    def kind(self, name):
+        "Returns a `Kind` grammar matching the tokens of rule `name` in a `lex`."
+        return Kind(self.ids[name], name)
+
+    def tokenize(self, text):
+        "Returns the list of token strings in `text`."
+        skip = self.skip
+        tokens = []
+        for match in self.pattern.finditer(text):
+            kind = match.lastgroup
+            if kind == "_error":
+                self.error(text, match.start())
+            elif kind not in skip:
+                tokens.append(match.group())
+        return tokens
+
+    def lex(self, text):
+        """
+        Returns the tokens in `text` as `Lexemes`, which hold the kind and the
+        offsets of each token rather than a string per token.
+        """
+        ids = self.ids
+        skip = self.skip
+        lexemes = Lexemes(text, self.names)
+        kinds = lexemes.kinds
+        starts = lexemes.starts
+        ends = lexemes.ends
+        for match in self.pattern.finditer(text):
+            kind = match.lastgroup
+            if kind == "_error":
+                self.error(text, match.start())
+            elif kind not in skip:
+                kinds.append(ids[kind])
+                (start, end) = match.span()
+                starts.append(start)
+                ends.append(end)
+        return lexemes
+
+    def error(self, text, offset):
+        raise Exception("Lexer: no token matches " + repr(text[offset:offset + 20]) +
+                        " at offset " + str(offset))
+
+
+class Lexemes(object):
+    """
+    The tokens of `text` found by `Lexer.lex`, in three parallel arrays:
+    the id of the rule that matched each one in `kinds`, and where it starts
+    and ends in the text in `starts` and `ends`.  `names` are the rules' names
+    by id.
+
+    Indexing it gives a token's string, so it can be the list of a `Cursor`
+    and parsed by any Grammar.  `Kind` grammars match on the ids instead.
+    """
+
+    __slots__ = ('text', 'names', 'kinds', 'starts', 'ends')
+
+    def __init__(self, text, names):
+        self.text = text
+        self.names = names
+        self.kinds = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        return self.text[self.starts[index]:self.ends[index]]
+
+    def kind(self, index):
+        "The name of the rule that matched the token at `index`."
+        return self.names[self.kinds[index]]
+
+
+class Kind(Grammar):
+    """
+    Matches a token of one kind in `Lexemes`, comparing its rule's id rather
+    than its text.  Its `Result.value` is the token's string.
+    Get one from `Lexer.kind`.
+    """
+
+    def __init__(self, id, kind, name = None):
+        Grammar.__init__(self, name)
+        self.id = id
+        self.kind = kind
+
+    def trace_repr(self):
+        return "Kind(" + self.kind + ")"
+
+    def rename(self, name):
+        return Kind(self.id, self.kind, name)
+
+    def parse_tokens(self, tokens, index, level, state):
+        if tokens.kinds[index] == self.id:
+            return (Result(tokens[index]), index + 1)
+        else:
+            return (False, index)
+
+    def compile_parser(self, compiler):
+        # the kinds are those of `Lexemes`, not of interned tokens
+        compiler.no_vocabulary(self)
+        id = self.id
+        def parse(tokens, index):
+            if index < len(tokens) and tokens.kinds[index] == id:
+                return (Result(tokens[index]), index + 1)
+            else:
+                return (False, index)
+        return parse
+
+    def compile_recognizer(self, compiler):
+        compiler.no_vocabulary(self)
+        id = self.id
+        def recognize(tokens, index):
+            if index < len(tokens) and tokens.kinds[index] == id:
+                return index + 1
+            else:
+                return None
+        return recognize
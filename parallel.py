@@ -0,0 +1,126 @@
+from importlib import import_module
+from multiprocessing import Pool, cpu_count
+from cursor import Cursor
+from grammar import Compiled, Result, compile
+
+# Parses many independent inputs at once, or one long input in pieces,
+# in a pool of worker processes.
+
+
+def parse_many(grammar, inputs, workers = None, chunksize = 64, tokenize = None):
+    """
+    Parses each of `inputs` with `grammar`, in a pool of `workers` processes
+    (by default one per CPU), yielding a pair for each input, in order, of
+    the `Result` and the index in its tokens where the parse ended.
+
+    Each input is a list of tokens, or if `tokenize` is given, whatever it
+    takes to return one, e.g. a string.  Inputs are sent to the workers
+    `chunksize` at a time.
+
+    The grammar is compiled once in each worker.  A grammar holding lambdas
+    can't be pickled, so on platforms where workers don't fork from this
+    process, pass `grammar` and `tokenize` by name instead, as the dotted
+    path to where they're defined, e.g. "bash_cartesian_product_grammar.top_level_expr".
+    The results, including the values your `map` functions return,
+    need to be picklable to come back from the workers.
+
+    With `workers = 1` the inputs are parsed in this process.
+    """
+    if workers == 1:
+        # parsed with locals, not `worker`, so that generators can take turns
+        parser = compiled(grammar)
+        tokenize = load(tokenize)
+        for input in inputs:
+            yield parse_input(parser, tokenize, input)
+        return
+    pool = Pool(workers, start_worker, (grammar, tokenize))
+    try:
+        for outcome in pool.imap(parse_one, inputs, chunksize):
+            yield outcome
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parse_chunked(grammar, tokens, resync, workers = None, chunks = None):
+    """
+    Parses the list `tokens` with `grammar`, a `OneOrMore`, by splitting it
+    into `chunks` pieces (by default four per worker), each ending just after
+    a `resync` token, and parsing the pieces in parallel with `parse_many`.
+    Returns the same pair as `parse_many` would for the whole list.
+
+    This is only the same as parsing the whole list if no repeat of the
+    `OneOrMore` spans a `resync` token, e.g. a ";" or a newline that can only
+    come at the end of one.  The pieces' results are merged as `OneOrMore`
+    would merge the repeats, keeps and all.
+    """
+    if chunks is None:
+        chunks = 4 * (workers or cpu_count())
+    pieces = split(tokens, resync, chunks)
+    results = []
+    end = 0
+    for (index, (result, piece_end)) in enumerate(parse_many(grammar, pieces, workers, 1)):
+        if result:
+            results.append(result)
+        end += piece_end
+        if piece_end < len(pieces[index]):
+            # the parse stopped in this piece, so it would have stopped there
+            # in the whole list too.
+            break
+    if not results:
+        return ([] if tokens else None, 0)
+    merged = Result.merge_all(results)
+    merged.value = [value for result in results for value in result.value]
+    return (merged, end)
+
+
+def split(tokens, resync, chunks):
+    """
+    Splits `tokens` into at most `chunks` lists of about the same length,
+    each but the last ending with a `resync` token.
+    """
+    size = max(1, len(tokens) // chunks)
+    pieces = []
+    start = 0
+    while start < len(tokens):
+        try:
+            end = tokens.index(resync, min(start + size, len(tokens)) - 1) + 1
+        except ValueError:
+            end = len(tokens)
+        pieces.append(tokens[start:end])
+        start = end
+    return pieces
+
+
+def load(reference):
+    "Returns the object named by the dotted path `reference`, or `reference` if it isn't a string."
+    if not isinstance(reference, str):
+        return reference
+    (module, name) = reference.rsplit(".", 1)
+    return getattr(import_module(module), name)
+
+
+def compiled(grammar):
+    "Returns the grammar `grammar` refers to, compiled."
+    grammar = load(grammar)
+    if not isinstance(grammar, Compiled):
+        grammar = compile(grammar)
+    return grammar
+
+
+def parse_input(parser, tokenize, input):
+    (result, end) = parser.parse(Cursor(input if tokenize is None else tokenize(input)))
+    return (result, end.index)
+
+
+# what a worker process of the pool parses with, set up by `start_worker`
+worker = {}
+
+
+def start_worker(grammar, tokenize):
+    worker['parser'] = compiled(grammar)
+    worker['tokenize'] = load(tokenize)
+
+
+def parse_one(input):
+    return parse_input(worker['parser'], worker['tokenize'], input)
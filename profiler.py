@@ -0,0 +1,138 @@
+import time
+from grammar import ParseState
+
+# Measures where a parse spends its time, grammar by grammar, for finding the
+# alternatives and rules that cost the most on real input.
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Profile:
+    """
+    Collects `Stats` for each grammar in the parses it's passed to, as in
+    `grammar.parse(cursor, profile = profile)`, adding up over as many
+    parses as it's given.  `report` lists them, most costly first.
+
+    It only profiles the recursive engine, not `iterative` parses.  A
+    `OneOrMore` that matches a run of single tokens in one loop counts as
+    one attempt, not one per token (see `OneOrMore.run`), and in packrat
+    mode every lookup of the memo table counts as an attempt.
+    """
+
+    def __init__(self):
+        # `Stats` by grammar
+        self.stats = {}
+        # the furthest index matched by the grammars in the parse in progress,
+        # for working out what a failure wasted
+        self.reach = -1
+        # the time spent in the sub-grammars of the grammar being parsed so far
+        self.children = 0.0
+        # how many times each grammar is being parsed, one inside the other
+        self.active = {}
+
+    def state(self, packrat = False, iterative = False, deferred = False):
+        "Returns the `ParseState` for `Grammar.parse` to parse with."
+        if iterative:
+            raise Exception("Profile: can't profile an iterative parse")
+        self.reach = -1
+        self.children = 0.0
+        self.active = {}
+        return ProfilingState(self, packrat, deferred)
+
+    def report(self, sort = 'exclusive', limit = 20):
+        """
+        Returns a table of the `limit` grammars with the most of `sort`,
+        one of the attributes of `Stats`, as a string.
+        """
+        rows = sorted(self.stats.items(), key = lambda item: getattr(item[1], sort), reverse = True)
+        lines = ["%9s %9s %9s %9s %12s %12s  %s" % ("attempts", "matches", "consumed", "wasted",
+                                                   "inclusive ms", "exclusive ms", "grammar")]
+        for (grammar, stats) in rows[:limit]:
+            label = repr(grammar)
+            if len(label) > 60:
+                label = label[:57] + "..."
+            lines.append("%9d %9d %9d %9d %12.3f %12.3f  %s" % (
+                stats.attempts, stats.matches, stats.consumed, stats.wasted,
+                stats.inclusive * 1000, stats.exclusive * 1000, label))
+        return "\n".join(lines)
+
+
+class Stats(object):
+    """
+    What a `Profile` recorded for one grammar:
+    `attempts` at parsing it, and how many were `matches` and `failures`;
+    the tokens `consumed` by its matches, and those `wasted` by its failures,
+    i.e. matched by its sub-grammars before it failed and backtracked;
+    and the time in seconds spent parsing it, `inclusive` of its
+    sub-grammars, or `exclusive` of them.  A grammar parsed inside itself,
+    as recursive grammars are, adds only the outermost parse's time to
+    `inclusive`.
+    """
+
+    __slots__ = ('attempts', 'matches', 'consumed', 'wasted', 'inclusive', 'exclusive')
+
+    def __init__(self):
+        self.attempts = 0
+        self.matches = 0
+        self.consumed = 0
+        self.wasted = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+
+    @property
+    def failures(self):
+        return self.attempts - self.matches
+
+    def __repr__(self):
+        return ("Stats(attempts=%d, matches=%d, consumed=%d, wasted=%d, inclusive=%f, exclusive=%f)" %
+                (self.attempts, self.matches, self.consumed, self.wasted, self.inclusive, self.exclusive))
+
+
+class ProfilingState(ParseState):
+    """
+    A `ParseState` that wraps `apply` to record each grammar's `Stats` in its
+    `profile`, which also keeps track of the parse in progress, so that it
+    carries on into the state a `Packrat` grammar parses with.
+    """
+
+    def __init__(self, profile, packrat = False, deferred = False):
+        ParseState.__init__(self, packrat, deferred = deferred)
+        # a `Compiled` grammar parses with the grammar it was compiled from
+        self.plain = False
+        self.profile = profile
+        self.inner = self.apply
+        self.apply = self.apply_profiled
+
+    def memoized(self):
+        return ProfilingState(self.profile, True, self.deferred)
+
+    def apply_profiled(self, grammar, tokens, index, level):
+        profile = self.profile
+        stats = profile.stats.get(grammar)
+        if stats is None:
+            stats = profile.stats[grammar] = Stats()
+        outer_reach = profile.reach
+        outer_children = profile.children
+        profile.reach = index
+        profile.children = 0.0
+        depth = profile.active.get(grammar, 0)
+        profile.active[grammar] = depth + 1
+        start = timer()
+        (result, end) = self.inner(grammar, tokens, index, level)
+        elapsed = timer() - start
+        profile.active[grammar] = depth
+
+        stats.attempts += 1
+        if result:
+            stats.matches += 1
+            stats.consumed += end - index
+            reach = max(profile.reach, end)
+        else:
+            reach = profile.reach
+            stats.wasted += reach - index
+        stats.exclusive += elapsed - profile.children
+        if depth == 0:
+            stats.inclusive += elapsed
+        profile.reach = max(outer_reach, reach)
+        profile.children = outer_children + elapsed
+        return (result, end)
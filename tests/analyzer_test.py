@@ -0,0 +1,93 @@
+import unittest
+from grammar import *
+from analyzer import analyze
+
+class Nothing(Grammar):
+    "Matches without consuming a token."
+
+    def trace_repr(self):
+        return "Nothing"
+
+    def rename(self, name):
+        return self
+
+    def nullable(self, seen = None):
+        return True
+
+    def parse_tokens(self, tokens, index, level, state):
+        return (Result(None), index)
+
+
+class AnalyzeTest(unittest.TestCase):
+
+    def kinds(self, grammar):
+        return [problem.kind for problem in analyze(grammar)]
+
+    def test_no_problems(self):
+        value = OneOf([AllOf([Token("("), Lazy(lambda: value), Token(")")]), Token("1")])
+        self.assertEqual(analyze(OneOrMore(value)), [])
+
+    def test_left_recursion(self):
+        expr = OneOf([Lazy(lambda: addition), Token("1")])
+        addition = AllOf([expr, Token("+"), Token("1")]).rename("addition")
+        problems = analyze(expr)
+        self.assertEqual([problem.kind for problem in problems],
+                         ["left recursion", "overlapping alternatives"])
+        self.assertTrue("addition" in problems[0].message)
+
+    def test_left_recursion_after_empty(self):
+        expr = AllOf([Nothing(), Lazy(lambda: expr), Token("1")])
+        self.assertEqual(self.kinds(expr), ["left recursion"])
+
+    def test_factored_right_recursion(self):
+        term = OneOf([AllOf([Token("("), Lazy(lambda: expr), Token(")")]), Token("n")])
+        expr = OneOf([AllOf([term, Token("+"), Lazy(lambda: expr)]),
+                      AllOf([term, Token("-"), Lazy(lambda: expr)]),
+                      term])
+        self.assertEqual(self.kinds(expr), ["overlapping alternatives"] * 3)
+        self.assertEqual(self.kinds(factor(expr)), [])
+
+    def test_factored_left_recursion(self):
+        expr = OneOf([AllOf([Lazy(lambda: expr), Token("+"), Token("n")]),
+                      AllOf([Lazy(lambda: expr), Token("-"), Token("n")])])
+        self.assertEqual(self.kinds(factor(expr)), ["left recursion"])
+
+    def test_not_left_recursion(self):
+        expr = AllOf([Token("1"), Lazy(lambda: expr)])
+        self.assertEqual(analyze(expr), [])
+
+    def test_empty_repetition(self):
+        repeat = OneOrMore(OneOf([Token("a"), Map(lambda value, keeps: value, Nothing())]))
+        problems = analyze(repeat)
+        self.assertEqual([problem.kind for problem in problems], ["empty repetition"])
+        self.assertTrue(problems[0].grammar is repeat)
+
+    def test_unreachable_alternative(self):
+        grammar = OneOf([Token("a"), AnyToken(), Token("b"), AllOf([Token("a"), Token("c")])])
+        problems = analyze(grammar)
+        self.assertEqual([problem.kind for problem in problems], ["unreachable alternative"] * 2)
+        self.assertTrue("alternative 2 " in problems[0].message)
+        self.assertTrue("alternative 3 " in problems[1].message)
+
+    def test_literals_sharing_a_first_character(self):
+        grammar = OneOf([Literal("if"), Literal("id")])
+        self.assertEqual(self.kinds(grammar), ["overlapping alternatives"])
+
+    def test_overlapping_alternatives(self):
+        grammar = OneOf([AllOf([Token("a"), Token("b")]), Token("c"), AllOf([Token("a"), Token("c")])])
+        problems = analyze(grammar)
+        self.assertEqual([problem.kind for problem in problems], ["overlapping alternatives"])
+        self.assertTrue("alternatives 0 and 2" in problems[0].message)
+        self.assertTrue(problems[0].message.endswith("'a'"))
+
+    def test_single_token_alternatives_dont_overlap(self):
+        grammar = OneOf([Token("a").map(lambda value, keeps: value), AllOf([Token("a"), Token("c")])])
+        self.assertEqual(analyze(grammar), [])
+
+    def test_nullable(self):
+        self.assertFalse(AllOf([Nothing(), Token("a")]).nullable())
+        self.assertTrue(AllOf([Nothing(), Nothing().keep('x')]).nullable())
+        self.assertTrue(OneOf([Token("a"), Nothing()]).nullable())
+        self.assertFalse(AllOf([]).nullable())
+        loop = Lazy(lambda: loop)
+        self.assertFalse(loop.nullable())
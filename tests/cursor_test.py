@@ -37,6 +37,15 @@ class CursorTestTraversal(unittest.TestCase):
         
         self.assertEqual(items, [1,2,3])
         self.assertTrue(tail3.empty())
+
+    def test_equal_on_equal_lists(self):
+        self.assertEqual(Cursor([1,2]).tail(), Cursor([1,2], 1))
+
+    def test_not_equal_at_different_index(self):
+        self.assertNotEqual(Cursor([1,2], 1), Cursor([1,2]))
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(Cursor([1]), '__dict__'))
         
 
 class CursorTestMapWhile(unittest.TestCase):
@@ -1,7 +1,10 @@
 import unittest
 from grammar import *
-from cursor import Cursor
+from cursor import Cursor, Buffer
+from tracing import Tracer
 import re
+import sys
+import io
         
 class ResultTest(unittest.TestCase):
 
@@ -226,3 +229,958 @@ class GrammarTest(unittest.TestCase):
     # for now, this is tested using the bash cartesian product grammar
     
 
+
+
+class PackratTest(unittest.TestCase):
+
+    def counting_grammar(self):
+        "A grammar that backtracks over `prefix`, counting each time it's parsed."
+        calls = []
+        def count(value, keeps):
+            calls.append(value)
+            return value
+        prefix = AnyToken().map(count)
+        grammar = OneOf([AllOf([prefix, Token("x")]),
+                         AllOf([prefix, Token("y")])])
+        return (grammar, calls)
+
+    def test_same_result_as_plain_parse(self):
+        (grammar, _) = self.counting_grammar()
+        input = Cursor(["a", "y", "z"])
+        self.assertEqual(grammar.parse(input, packrat = True), grammar.parse(input))
+
+    def test_backtracking_reuses_memoized_result(self):
+        (grammar, calls) = self.counting_grammar()
+        grammar.parse(Cursor(["a", "y"]))
+        self.assertEqual(calls, ["a", "a"])
+        del calls[:]
+        (result, end) = grammar.parse(Cursor(["a", "y"]), packrat = True)
+        self.assertEqual(calls, ["a"])
+        self.assertEqual(result, Result(["a", "y"]))
+        self.assertTrue(end.empty())
+
+    def test_memo_scoped_to_one_parse(self):
+        (grammar, calls) = self.counting_grammar()
+        grammar.parse(Cursor(["a", "y"]), packrat = True)
+        grammar.parse(Cursor(["b", "y"]), packrat = True)
+        self.assertEqual(calls, ["a", "b"])
+
+    def test_packrat_grammar_root(self):
+        (grammar, calls) = self.counting_grammar()
+        (result, end) = grammar.packrat().parse(Cursor(["a", "y"]))
+        self.assertEqual(calls, ["a"])
+        self.assertEqual(result, Result(["a", "y"]))
+
+    def test_no_match(self):
+        (grammar, _) = self.counting_grammar()
+        input = Cursor(["a", "z"])
+        (result, end) = grammar.parse(input, packrat = True)
+        self.assertFalse(result)
+        self.assertEqual(end, input)
+
+
+class LeftRecursionTest(unittest.TestCase):
+
+    number = OneOf([Token("1"), Token("2"), Token("3")])
+
+    @staticmethod
+    def operation(values, keeps):
+        (left, op, right) = values
+        return (left, op, right)
+
+    def test_direct_left_recursion_is_left_associative(self):
+        number = LeftRecursionTest.number
+        expr = OneOf([Lazy(lambda: addition), Lazy(lambda: subtraction), number])
+        addition = AllOf([expr, Token("+"), number]).map(self.operation)
+        subtraction = AllOf([expr, Token("-"), number]).map(self.operation)
+        input = Cursor(["1", "+", "2", "-", "3", "+", "1", ")"])
+        (result, end) = expr.parse(input, packrat = True)
+        self.assertEqual(result.value, ((("1", "+", "2"), "-", "3"), "+", "1"))
+        self.assertEqual(end, input.at(7))
+
+    def test_indirect_left_recursion(self):
+        number = LeftRecursionTest.number
+        expr = OneOf([Lazy(lambda: addition), number])
+        term = OneOf([Lazy(lambda: expr)])
+        addition = AllOf([term, Token("+"), number]).map(self.operation)
+        (result, end) = expr.parse(Cursor(["1", "+", "2", "+", "3"]), packrat = True)
+        self.assertEqual(result.value, (("1", "+", "2"), "+", "3"))
+        self.assertTrue(end.empty())
+
+    def test_seed_only(self):
+        number = LeftRecursionTest.number
+        expr = OneOf([Lazy(lambda: addition), number])
+        addition = AllOf([expr, Token("+"), number]).map(self.operation)
+        input = Cursor(["2", "+"])
+        (result, end) = expr.parse(input, packrat = True)
+        self.assertEqual(result.value, "2")
+        self.assertEqual(end, input.at(1))
+
+    def test_no_match(self):
+        number = LeftRecursionTest.number
+        expr = OneOf([Lazy(lambda: addition), number])
+        addition = AllOf([expr, Token("+"), number]).map(self.operation)
+        input = Cursor(["+", "1"])
+        (result, end) = expr.parse(input, packrat = True)
+        self.assertFalse(result)
+        self.assertEqual(end, input)
+
+
+class CompileTest(unittest.TestCase):
+
+    def assertParsesSame(self, grammar, tokens):
+        input = Cursor(tokens)
+        self.assertEqual(compile(grammar).parse(input), grammar.parse(input))
+
+    def test_tokens(self):
+        self.assertParsesSame(Token("a"), ["a"])
+        self.assertParsesSame(Token("a"), ["b"])
+        self.assertParsesSame(AnyToken(), ["b"])
+        self.assertParsesSame(AnyToken(), [])
+
+    def test_structure(self):
+        grammar = OneOf([AllOf([Token("a"), Token("b")]),
+                         OneOrMore(Unless(Token("c"), AnyToken()))])
+        for tokens in [["a", "b"], ["a", "c"], ["a", "a", "c"], ["c"], []]:
+            self.assertParsesSame(grammar, tokens)
+
+    def test_keeps_and_maps(self):
+        grammar = AllOf([Token("a").keep('a'),
+                         AnyToken().map(lambda v, keeps: v + "!").keep('b')]
+        ).map(lambda v, keeps: keeps).clear()
+        self.assertParsesSame(grammar, ["a", "b"])
+        self.assertParsesSame(grammar, ["b", "b"])
+
+    def test_recursive_lazy(self):
+        nested = OneOf([AllOf([Token("("), Lazy(lambda: nested), Token(")")]),
+                        Token("x")])
+        self.assertParsesSame(nested, ["(", "(", "x", ")", ")"])
+        self.assertParsesSame(nested, ["(", "(", "x", ")"])
+
+    def test_lazy_thunk_resolved_once(self):
+        calls = []
+        def thunk():
+            calls.append(1)
+            return Token("x")
+        compiled = compile(OneOrMore(Lazy(thunk)))
+        (result, end) = compiled.parse(Cursor(["x", "x", "x"]))
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(end.empty())
+
+    def test_nested_in_other_grammars(self):
+        grammar = AllOf([compile(Token("a")), Token("b")])
+        self.assertParsesSame(grammar, ["a", "b"])
+
+    def test_packrat_parses_with_original_grammar(self):
+        expr = OneOf([Lazy(lambda: addition), Token("1")])
+        addition = AllOf([expr, Token("+"), Token("1")])
+        input = Cursor(["1", "+", "1"])
+        (result, end) = compile(expr).parse(input, packrat = True)
+        self.assertEqual((result, end), expr.parse(input, packrat = True))
+
+
+class FreezeTest(unittest.TestCase):
+
+    def counting_lazy(self, calls, grammar):
+        def thunk():
+            calls.append(grammar)
+            return grammar
+        return Lazy(thunk)
+
+    def test_lazy_resolves_once(self):
+        calls = []
+        grammar = OneOrMore(self.counting_lazy(calls, Token("x")))
+        grammar.parse(Cursor(["x", "x"]))
+        grammar.parse(Cursor(["x"]))
+        self.assertEqual(len(calls), 1)
+
+    def test_freeze_resolves_whole_graph(self):
+        calls = []
+        inner = self.counting_lazy(calls, Token("y"))
+        outer = self.counting_lazy(calls, AllOf([Token("x"), inner]))
+        grammar = OneOf([outer, Token("z")])
+        self.assertTrue(grammar.freeze() is grammar)
+        self.assertEqual(len(calls), 2)
+        (result, end) = grammar.parse(Cursor(["x", "y"]))
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(end.empty())
+
+    def test_freeze_recursive_grammar(self):
+        nested = OneOf([AllOf([Token("("), Lazy(lambda: nested), Token(")")]),
+                        Token("x")])
+        nested.freeze()
+        (result, end) = nested.parse(Cursor(["(", "x", ")"]))
+        self.assertTrue(end.empty())
+
+
+class FirstTest(unittest.TestCase):
+
+    def test_token(self):
+        self.assertEqual(Token("a").first(), First(["a"]))
+
+    def test_any_token(self):
+        self.assertEqual(AnyToken().first(), First.ANY)
+
+    def test_all_of_prefix(self):
+        self.assertEqual(AllOf([Token("a"), Token("b")]).first(), First(["a"]))
+
+    def test_one_of_union(self):
+        grammar = OneOf([Token("a"), AllOf([Token("b"), Token("a")])])
+        self.assertEqual(grammar.first(), First(["a", "b"]))
+
+    def test_unless_exclusion(self):
+        grammar = Unless(OneOf([Token(","), Token("}")]), AnyToken().map(lambda v, ks: v))
+        self.assertEqual(grammar.first(), First([",", "}"], excluding = True))
+        self.assertFalse("," in grammar.first())
+        self.assertTrue("a" in grammar.first())
+
+    def test_recursive_lazy(self):
+        expr = OneOf([AllOf([Lazy(lambda: expr), Token("+")]), Token("1")])
+        self.assertEqual(expr.first(), First(["1"]))
+
+
+class OneOfDispatchTest(unittest.TestCase):
+
+    def test_dispatch_table(self):
+        a = Token("a")
+        ab = AllOf([Token("a"), Token("b")])
+        c = Token("c")
+        not_a = Unless(Token("a"), AnyToken())
+        (table, others) = OneOf([ab, a, c, not_a]).dispatch_table()
+        self.assertEqual(table, { "a": [ab, a], "c": [c, not_a] })
+        self.assertEqual(others, [not_a])
+
+    def test_tries_candidates_in_order(self):
+        grammar = OneOf([AllOf([Token("a"), Token("b")]), Token("a"), Token("c")])
+        input = Cursor(["a", "c"])
+        (result, end) = grammar.parse(input)
+        self.assertEqual(result.value, "a")
+        self.assertEqual(end, input.at(1))
+
+    def test_falls_back_to_others(self):
+        grammar = OneOf([Token("a"), Unless(Token("b"), AnyToken())])
+        (result, end) = grammar.parse(Cursor(["z"]))
+        self.assertEqual(result.value, "z")
+        (result, end) = grammar.parse(Cursor(["b"]))
+        self.assertFalse(result)
+
+    def test_unhashable_tokens(self):
+        grammar = OneOf([Token("a"), AnyToken()])
+        (result, end) = grammar.parse(Cursor([["a"]]))
+        self.assertEqual(result.value, ["a"])
+        (result, end) = compile(grammar).parse(Cursor([["a"]]))
+        self.assertEqual(result.value, ["a"])
+
+    def test_frozen_grammar_has_dispatch_table(self):
+        grammar = OneOf([Lazy(lambda: Token("x")), Token("y")]).freeze()
+        self.assertEqual(grammar.dispatch[0]["x"], [grammar.grammars[0]])
+
+
+class KeepsTest(unittest.TestCase):
+
+    def test_merge_shares_single_keeps(self):
+        kept = Result("b", { 'b': 2 })
+        merged = Result.merge_all([Result("a"), kept, Result("c")])
+        self.assertTrue(merged.kept is kept.kept)
+
+    def test_merge_without_keeps(self):
+        merged = Result.merge_all([Result("a"), Result("b")])
+        self.assertEqual(merged.kept, None)
+        self.assertEqual(merged.keeps, {})
+
+    def test_later_keeps_replace_earlier(self):
+        merged = Result.merge_all([Result("a", { 'k': 1, 'a': 1 }), Result("b", { 'k': 2 })])
+        self.assertEqual(merged.keeps, { 'k': 2, 'a': 1 })
+
+    def test_contains(self):
+        keeps = Keeps([Keeps(items = { 'a': 1 }), Keeps(items = { 'b': 2 })], { 'c': 3 })
+        self.assertTrue('a' in keeps)
+        self.assertTrue('c' in keeps)
+        self.assertFalse('d' in keeps)
+        self.assertEqual(keeps.to_dict(), { 'a': 1, 'b': 2, 'c': 3 })
+
+    def test_duplicate_keep_raises(self):
+        grammar = AllOf([Token("a").keep('k'), Token("b")]).keep('k')
+        self.assertRaises(Exception, grammar.parse, Cursor(["a", "b"]))
+
+
+class CursorGrammarTest(unittest.TestCase):
+
+    class Pair(Grammar):
+        "A grammar written against cursors: matches its grammar twice."
+
+        def __init__(self, grammar, name = None):
+            Grammar.__init__(self, name)
+            self.grammar = grammar
+
+        def parse_non_empty(self, cursor, level, state):
+            (first, middle) = state.apply_cursor(self.grammar, cursor, level + 1)
+            (second, end) = state.apply_cursor(self.grammar, middle, level + 1)
+            if first and second:
+                return (Result.merge_all([first, second]), end)
+            else:
+                return (None, cursor)
+
+    class OldPair(Grammar):
+        "`Pair` as written before `ParseState`."
+
+        def __init__(self, grammar, name = None):
+            Grammar.__init__(self, name)
+            self.grammar = grammar
+
+        def parse_non_empty(self, cursor, level):
+            (first, middle) = self.grammar.parse(cursor, level + 1)
+            (second, end) = self.grammar.parse(middle, level + 1)
+            if first and second:
+                return (Result.merge_all([first, second]), end)
+            else:
+                return (None, cursor)
+
+    class OldLazy(Grammar):
+        "A grammar that overrides `parse`, as `Lazy` once did."
+
+        def __init__(self, thunk, name = None):
+            Grammar.__init__(self, name)
+            self.thunk = thunk
+
+        def parse(self, cursor, level = 0):
+            return self.thunk().parse(cursor, level + 1)
+
+    class CaseInsensitiveToken(Token):
+        "A `Token` matching either case, written before `ParseState`."
+
+        def parse_non_empty(self, cursor, level):
+            if cursor.head().lower() == self.value:
+                return (Result(cursor.head()), cursor.tail())
+            else:
+                return (None, cursor)
+
+    class CountedToken(Token):
+        "A `Token` whose `parse` counts its calls and calls the one it overrides."
+
+        def __init__(self, value, name = None):
+            Token.__init__(self, value, name)
+            self.calls = 0
+
+        def parse(self, cursor, level = 0):
+            self.calls += 1
+            return Token.parse(self, cursor, level)
+
+    def test_subclasses_of_built_in_grammars(self):
+        for grammar in (AllOf([CursorGrammarTest.CaseInsensitiveToken("a"), Token("b")]),
+                        OneOrMore(OneOf([CursorGrammarTest.CaseInsensitiveToken("a"), Token("b")]))):
+            input = Cursor(["A", "b"])
+            for parser in (grammar, compile(grammar)):
+                (result, end) = parser.parse(input)
+                self.assertEqual(result.value, ["A", "b"])
+                self.assertEqual(end.index, 2)
+            self.assertEqual(grammar.parse(input, iterative = True)[1].index, 2)
+            self.assertEqual(grammar.recognize(input), 2)
+        counted = CursorGrammarTest.CountedToken("a")
+        (result, end) = AllOf([counted, Token("b")]).parse(Cursor(["a", "b"]))
+        self.assertEqual(result.value, ["a", "b"])
+        self.assertEqual(counted.calls, 1)
+        self.assertFalse(AllOf([counted, Token("b")]).parse(Cursor(["b", "b"]))[0])
+
+    def test_grammars_written_before_parse_state(self):
+        expected = AllOf([CursorGrammarTest.Pair(Token("a")), Token("b")]).parse(Cursor(["a", "a", "b"]))
+        for pair in (CursorGrammarTest.OldPair(Token("a")),
+                     CursorGrammarTest.OldPair(CursorGrammarTest.OldLazy(lambda: Token("a")))):
+            grammar = AllOf([pair, Token("b")])
+            for packrat in (False, True):
+                (result, end) = grammar.parse(Cursor(["a", "a", "b"]), packrat = packrat)
+                self.assertEqual((result, end.index), (expected[0], expected[1].index))
+            self.assertFalse(grammar.parse(Cursor(["a", "b"]))[0])
+        grammar = AllOf([CursorGrammarTest.OldLazy(lambda: Token("a")), Token("b")])
+        self.assertEqual(grammar.parse(Cursor(["a", "b"]))[0].value, ["a", "b"])
+
+    def test_cursor_grammar(self):
+        grammar = AllOf([CursorGrammarTest.Pair(Token("a")), Token("b")])
+        input = Cursor(["a", "a", "b", "c"])
+        (result, end) = grammar.parse(input)
+        self.assertEqual(result.value, [["a", "a"], "b"])
+        self.assertEqual(end, input.at(3))
+
+    def test_cursor_grammar_packrat_and_compiled(self):
+        grammar = OneOf([CursorGrammarTest.Pair(Token("a")), Token("a")])
+        input = Cursor(["a", "b"])
+        self.assertEqual(grammar.parse(input, packrat = True), grammar.parse(input))
+        self.assertEqual(compile(grammar).parse(input), grammar.parse(input))
+
+
+class IterativeTest(unittest.TestCase):
+
+    def nested(self):
+        "Parenthesized `x`s, nested to any depth."
+        expr = OneOf([Token("x"), AllOf([Token("("), Lazy(lambda: expr), Token(")")])])
+        return expr
+
+    def test_same_as_recursive(self):
+        grammar = AllOf([OneOrMore(OneOf([Token("a"), Token("b")]).keep('ab')),
+                         Unless(Token("a"), AnyToken()).map(lambda v, k: v.upper())])
+        for tokens in (["a", "c"], ["b", "b", "d", "e"], ["a"], ["c"]):
+            input = Cursor(tokens)
+            self.assertEqual(grammar.parse(input, iterative = True), grammar.parse(input))
+            self.assertEqual(grammar.parse(input, packrat = True, iterative = True),
+                             grammar.parse(input))
+
+    def test_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 2
+        input = Cursor(["("] * depth + ["x"] + [")"] * depth)
+        (result, end) = self.nested().parse(input, iterative = True)
+        self.assertTrue(result)
+        self.assertTrue(end.empty())
+
+    def test_no_match(self):
+        input = Cursor(["(", "(", "x", ")"])
+        (result, end) = self.nested().parse(input, iterative = True)
+        self.assertFalse(result)
+        self.assertEqual(end, input)
+
+    def test_left_recursion_raises(self):
+        expr = OneOf([AllOf([Lazy(lambda: expr), Token("+"), Token("1")]), Token("1")])
+        with self.assertRaises(Exception):
+            expr.parse(Cursor(["1", "+", "1"]), packrat = True, iterative = True)
+
+    def test_compiled_and_cursor_grammars(self):
+        grammar = OneOf([CursorGrammarTest.Pair(Token("a")), Token("a")])
+        input = Cursor(["a", "a", "b"])
+        self.assertEqual(compile(grammar).parse(input, iterative = True), grammar.parse(input))
+
+
+class ParseStreamTest(unittest.TestCase):
+
+    def pairs(self):
+        return AllOf([AnyToken().keep('key'), Token("="), OneOrMore(Unless(Token(";"), AnyToken())),
+                      Token(";")]).map(lambda value, keeps: keeps['key'])
+
+    def test_yields_each_match(self):
+        tokens = iter(["a", "=", "1", ";", "b", "=", "2", "3", ";"])
+        results = [result.value for result in self.pairs().parse_stream(tokens)]
+        self.assertEqual(results, ["a", "b"])
+
+    def test_one_or_more_streams_repetitions(self):
+        tokens = (token for token in ["a", "b", "c"])
+        results = [result.value for result in OneOrMore(AnyToken()).parse_stream(tokens)]
+        self.assertEqual(results, ["a", "b", "c"])
+
+    def test_stops_where_it_doesnt_match(self):
+        tokens = iter(["a", "=", "1", ";", "b", ";", "c", "=", "3", ";"])
+        results = [result.value for result in self.pairs().parse_stream(tokens)]
+        self.assertEqual(results, ["a"])
+
+    def test_matches_longer_than_buffer(self):
+        def tokens():
+            for key in range(12):
+                yield str(key)
+                yield "="
+                for value in range(key * 400 + 1):
+                    yield "v"
+                yield ";"
+        for (packrat, iterative) in ((False, False), (True, False), (False, True)):
+            results = [result.value for result in
+                       self.pairs().parse_stream(tokens(), packrat, iterative)]
+            self.assertEqual(results, [str(key) for key in range(12)])
+
+    def test_buffer_drops_parsed_tokens(self):
+        buffer = Buffer(range(10), size = 4)
+        self.assertTrue(buffer.fill())
+        self.assertEqual(buffer.tokens, [0, 1, 2, 3])
+        buffer.advance(3)
+        buffer.fill()
+        self.assertEqual(buffer.tokens[buffer.start:], [3, 4, 5, 6])
+        buffer.advance(buffer.start + 4)
+        self.assertEqual(buffer.tokens, [])
+        self.assertTrue(buffer.fill())
+        self.assertEqual(buffer.tokens, [7, 8, 9])
+        self.assertTrue(buffer.exhausted)
+
+
+class CommitTest(unittest.TestCase):
+
+    def statement(self):
+        "`if x ;` committed after the `if`, or any tokens up to a `;`."
+        return OneOf([AllOf([Token("if").commit(), Token("x"), Token(";")]),
+                      AllOf([OneOrMore(Unless(Token(";"), AnyToken())), Token(";")])])
+
+    def test_matches(self):
+        input = Cursor(["if", "x", ";"])
+        (result, end) = self.statement().parse(input)
+        self.assertEqual(result.value, ["if", "x", ";"])
+        self.assertTrue(end.empty())
+
+    def test_does_not_try_later_alternatives(self):
+        input = Cursor(["if", "y", ";"])
+        (result, end) = self.statement().parse(input)
+        self.assertFalse(result)
+        self.assertEqual(end, input)
+
+    def test_uncommitted_alternative_backtracks(self):
+        grammar = OneOf([AllOf([Token("if"), Token("x")]), AnyToken()])
+        (result, _) = grammar.parse(Cursor(["if", "y"]))
+        self.assertEqual(result.value, "if")
+
+    def test_all_of_fails_with_committed(self):
+        grammar = AllOf([Token("if").commit().keep('keyword'), Token("x")])
+        (result, _) = grammar.parse(Cursor(["if", "y"]))
+        self.assertTrue(result is Commit.FAILED)
+        (result, _) = grammar.parse(Cursor(["else", "x"]))
+        self.assertTrue(result is None)
+
+    def test_nested_all_of(self):
+        grammar = OneOf([AllOf([AllOf([Token("if").commit(), Token("x")]).map(lambda v, k: v)]),
+                         AnyToken()])
+        (result, _) = grammar.parse(Cursor(["if", "y"]))
+        self.assertFalse(result)
+
+    def test_commit_an_all_of(self):
+        grammar = OneOf([AllOf([AllOf([Token("if"), Token("x")]).commit(), Token(";")]), AnyToken()])
+        self.assertEqual(grammar.parse(Cursor(["if", "y"]))[0].value, "if")
+        self.assertFalse(grammar.parse(Cursor(["if", "x", "y"]))[0])
+
+    def test_certain_first_stops_at_a_commit(self):
+        keyword = OneOf([AllOf([Commit(Token("a")), Token("b")]), Token("a")])
+        self.assertEqual(keyword.certain_first(), First.NONE)
+        word = Unless(keyword, AnyToken())
+        grammar = OneOf([word, Token("(")])
+        input = Cursor(["a", "c"])
+        self.assertEqual(word.parse(input)[0].value, "a")
+        self.assertEqual(grammar.parse(input)[0].value, "a")
+        self.assertEqual(compile(grammar).parse(input)[0].value, "a")
+        self.assertEqual(OneOf([Token("a"), AllOf([Commit(Token("b")), Token("c")]), Token("c")]).certain_first(),
+                         First(["a"]))
+
+    def test_local_to_its_one_of(self):
+        grammar = OneOf([self.statement(), AnyToken()])
+        (result, end) = grammar.parse(Cursor(["if", "y", ";"]))
+        self.assertEqual(result.value, "if")
+
+    def test_same_in_every_engine(self):
+        for tokens in (["if", "x", ";"], ["if", "y", ";"], ["a", "b", ";"], ["if"]):
+            input = Cursor(tokens)
+            expected = self.statement().parse(input)
+            self.assertEqual(self.statement().parse(input, packrat = True), expected)
+            self.assertEqual(self.statement().parse(input, iterative = True), expected)
+            self.assertEqual(compile(self.statement()).parse(input), expected)
+
+
+class ScannerlessTest(unittest.TestCase):
+
+    def sum(self):
+        number = Regex(" *[0-9]+").map(lambda value, keeps: int(value))
+        return AllOf([number.keep('left'), Regex(r" *\+"), number.keep('right')]).map(
+            lambda value, keeps: keeps['left'] + keeps['right'])
+
+    def test_literal(self):
+        (result, end) = Literal("if").parse(Cursor("if x"))
+        self.assertEqual(result.value, "if")
+        self.assertEqual(end.index, 2)
+        (result, end) = Literal("if").parse(Cursor("i"))
+        self.assertFalse(result)
+
+    def test_regex(self):
+        (result, end) = Regex("[0-9]+").parse(Cursor("42 + 1"))
+        self.assertEqual(result.value, "42")
+        self.assertEqual(end.index, 2)
+
+    def test_regex_empty_match_is_no_match(self):
+        (result, end) = Regex("[0-9]*").parse(Cursor("x"))
+        self.assertFalse(result)
+        self.assertEqual(end.index, 0)
+
+    def test_parse_text(self):
+        input = Cursor("12 + 30 rest")
+        (result, end) = self.sum().parse(input)
+        self.assertEqual(result.value, 42)
+        self.assertEqual(end.index, 7)
+        self.assertEqual(compile(self.sum()).parse(input), (result, end))
+        self.assertEqual(self.sum().parse(input, packrat = True, iterative = True), (result, end))
+        (result, end) = self.sum().parse(Cursor("2+3"))
+        self.assertEqual(result.value, 5)
+
+    def test_one_of_dispatches_on_first_character(self):
+        grammar = OneOf([Literal("if"), Literal("in"), Literal("else"), Regex("[a-z]+")])
+        self.assertEqual(grammar.dispatch_table()[0]["i"], grammar.grammars[:2] + [grammar.grammars[3]])
+        self.assertEqual(grammar.parse(Cursor("else"))[0].value, "else")
+        self.assertEqual(grammar.parse(Cursor("into"))[0].value, "in")
+        self.assertEqual(grammar.parse(Cursor("x"))[0].value, "x")
+
+    def test_keyword_exclusion(self):
+        # "identifier" starts with the "i" of "if", but isn't "if"
+        word = Unless(Literal("if"), Regex("[a-z]+"))
+        grammar = OneOf([word, Literal("(")])
+        input = Cursor("identifier")
+        self.assertEqual(grammar.parse(input)[1].index, 10)
+        self.assertEqual(compile(grammar).parse(input)[1].index, 10)
+        self.assertEqual(grammar.recognize(input), 10)
+        self.assertFalse(grammar.parse(Cursor("if"))[0])
+        self.assertEqual(Literal("if").certain_first(), First.NONE)
+        self.assertEqual(Literal("(").certain_first(), First(["("]))
+
+
+class VocabularyTest(unittest.TestCase):
+
+    def test_intern(self):
+        vocabulary = Vocabulary(["a"])
+        codes = vocabulary.intern(["b", "a", "b"])
+        self.assertEqual(list(codes), [1, 0, 1])
+        self.assertEqual(vocabulary.words, ["a", "b"])
+
+    def test_compiled_grammar_parses_interned_tokens(self):
+        grammar = AllOf([OneOf([Token("let"), Token("var")]), AnyToken().keep('name'), Token("=")]).map(
+            lambda value, keeps: keeps['name'])
+        vocabulary = Vocabulary()
+        parser = compile(grammar, vocabulary)
+        for tokens in (["let", "x", "=", "1"], ["var", "y", "="], ["let", "x", "+"], ["x"]):
+            (expected, expected_end) = grammar.parse(Cursor(tokens))
+            (result, end) = parser.parse(Cursor(vocabulary.intern(tokens)))
+            self.assertEqual(result, expected)
+            self.assertEqual(end.index, expected_end.index)
+
+    def test_runs_of_interned_tokens(self):
+        grammars = [OneOrMore(Token("a")),
+                    OneOrMore(Unless(Token(","), AnyToken())),
+                    OneOrMore(Unless(Token(","), AnyToken().map(lambda value, keeps: value.upper())))]
+        for grammar in grammars:
+            vocabulary = Vocabulary()
+            parser = compile(grammar, vocabulary)
+            for tokens in (["a", "a", "b", ","], ["b", ","], [",", "a"]):
+                (expected, expected_end) = grammar.parse(Cursor(tokens))
+                for interned in (vocabulary.intern(tokens), list(vocabulary.intern(tokens))):
+                    (result, end) = parser.parse(Cursor(interned))
+                    self.assertEqual(result, expected)
+                    self.assertEqual(end.index, expected_end.index)
+                    self.assertEqual(parser.recognize(Cursor(interned)),
+                                     expected_end.index if expected else None)
+
+    def test_grammars_without_vocabulary_support_raise(self):
+        class Pair(CursorGrammarTest.Pair):
+            pass
+        for grammar in (OneOrMore(OneOf([Token("a"), Token("b")])).packrat(),
+                        AllOf([Token("a"), Pair(Token("b"))])):
+            vocabulary = Vocabulary()
+            with self.assertRaises(Exception):
+                compile(grammar, vocabulary)
+            with self.assertRaises(Exception):
+                Compiler(vocabulary, recognize = True).compile(grammar)
+
+    def test_nested_compiled_grammar(self):
+        inner = compile(OneOf([Token("a"), Token("b")]))
+        vocabulary = Vocabulary()
+        parser = compile(OneOrMore(inner), vocabulary)
+        (result, end) = parser.parse(Cursor(vocabulary.intern(list("abab"))))
+        self.assertEqual(result.value, list("abab"))
+        self.assertEqual(parser.recognize(Cursor(vocabulary.intern(list("abab")))), 4)
+        with self.assertRaises(Exception):
+            compile(Token("a"), vocabulary).parse_tokens(vocabulary.intern(["a"]), 0, 0,
+                                                         ParseState(packrat = True))
+
+    def test_interned_only_compiled(self):
+        vocabulary = Vocabulary()
+        parser = compile(Token("a"), vocabulary)
+        with self.assertRaises(Exception):
+            parser.parse(Cursor(vocabulary.intern(["a"])), packrat = True)
+
+
+class SingleTokenRunTest(unittest.TestCase):
+
+    def test_single_token(self):
+        self.assertEqual(Token("a").single_token(), (First(["a"]), None))
+        self.assertEqual(Unless(OneOf([Token(","), Token("}")]), AnyToken()).single_token(),
+                         (First([",", "}"], True), None))
+        self.assertEqual(AllOf([Token("a")]).single_token(), None)
+        self.assertEqual(Unless(AllOf([Token("a"), Token("b")]), AnyToken()).single_token(), None)
+
+    def test_recursive_lazy_is_not_single_token(self):
+        grammar = OneOf([Token("a"), Lazy(lambda: grammar)])
+        self.assertEqual(grammar.single_token(), None)
+
+    def test_same_as_one_at_a_time(self):
+        literal = AnyToken().map(lambda value, keeps: value.upper()).keep('literal')
+        grammars = [OneOrMore(Token("a")),
+                    OneOrMore(Unless(OneOf([Token(","), Token("}")]), AnyToken())),
+                    OneOrMore(Unless(Token(","), literal)),
+                    OneOrMore(OneOf([Token("a").map(lambda value, keeps: 1), Token("b")]))]
+        for tokens in (["a", "a", "b", ","], ["b", "a"], [",", "a"], ["a", "a"]):
+            input = Cursor(tokens)
+            for grammar in grammars:
+                one_at_a_time = OneOrMore(grammar.grammar)
+                one_at_a_time.single = False
+                expected = one_at_a_time.parse(input)
+                self.assertEqual(grammar.parse(input), expected)
+                self.assertEqual(compile(grammar).parse(input), expected)
+
+    def test_rejected_token_ends_the_run(self):
+        grammar = OneOrMore(AnyToken().mapResult(lambda result: result if result.value != "b" else None))
+        input = Cursor(["c", "b", "c", "b"])
+        ends = [grammar.parse(input)[1].index,
+                compile(grammar).parse(input)[1].index,
+                grammar.parse(input, iterative = True)[1].index,
+                grammar.parse(input, packrat = True)[1].index]
+        Grammar.trace = Tracer()
+        try:
+            ends.append(grammar.parse(input)[1].index)
+            ends.append(grammar.parse(input, iterative = True)[1].index)
+        finally:
+            Grammar.trace = False
+        self.assertEqual(ends, [1] * 6)
+
+    def test_unhashable_tokens(self):
+        input = Cursor([["a"], ["b"], ","])
+        (result, end) = OneOrMore(Unless(Token(","), AnyToken())).parse(input)
+        self.assertEqual(result.value, [["a"], ["b"]])
+        self.assertEqual(end.index, 2)
+
+
+def to_pair(value, keeps):
+    return (keeps['name'], keeps['value'])
+
+class DumpTest(unittest.TestCase):
+
+    def assignments(self):
+        assignment = AllOf([AnyToken().keep('name'), Token("="), Lazy(lambda: value).keep('value')])
+        value = OneOf([AllOf([Token("("), Lazy(lambda: value), Token(")")]).clear(), Token("1")])
+        return OneOrMore(Unless(Token(";"), assignment.map(to_pair))).packrat()
+
+    def reload(self, grammar):
+        file = io.BytesIO()
+        dump(grammar, file)
+        file.seek(0)
+        return load(file)
+
+    def test_dump_and_load(self):
+        input = Cursor(["a", "=", "(", "1", ")", "b", "=", "1", ";"])
+        self.assertEqual(self.reload(self.assignments()).parse(input),
+                         self.assignments().parse(input))
+
+    def test_lazy_loads_resolved(self):
+        grammar = self.reload(OneOf([Token("x"), Lazy(lambda: Token("y"))]))
+        self.assertEqual(grammar.grammars[1].grammar.value, "y")
+        self.assertEqual(grammar.grammars[1].thunk, None)
+
+    def test_compiled(self):
+        input = Cursor(["a", "=", "1"])
+        self.assertEqual(self.reload(compile(self.assignments())).parse(input),
+                         self.assignments().parse(input))
+
+    def test_lambda_cannot_be_dumped(self):
+        with self.assertRaises(Exception):
+            dump(AnyToken().map(lambda value, keeps: value), io.BytesIO())
+
+
+class DeferredTest(unittest.TestCase):
+
+    def counted(self, calls):
+        def to_sum(value, keeps):
+            calls.append(value)
+            return sum(value[::2])
+        number = Token("1").map(lambda value, keeps: int(value))
+        sum_ = AllOf([number, Token("+"), number]).map(to_sum)
+        return OneOf([AllOf([sum_, Token(";")]).keep('statement'), AllOf([sum_, Token(".")])])
+
+    def test_maps_only_the_final_match(self):
+        calls = []
+        input = Cursor(["1", "+", "1", "."])
+        (result, end) = self.counted(calls).parse(input, deferred = True)
+        self.assertEqual(result, Result([2, "."]))
+        self.assertEqual(calls, [[1, "+", 1]])
+        calls = []
+        self.assertEqual(self.counted(calls).parse(input), (result, end))
+        self.assertEqual(len(calls), 2)
+
+    def test_keeps_are_mapped(self):
+        calls = []
+        (result, end) = self.counted(calls).parse(Cursor(["1", "+", "1", ";"]), deferred = True)
+        self.assertEqual(result, Result([2, ";"], { 'statement': [2, ";"] }))
+        self.assertEqual(len(calls), 1)
+
+    def test_map_result_sees_mapped_values(self):
+        grammar = Token("1").map(lambda value, keeps: int(value)).mapResult(lambda result: Result(result.value + 1))
+        (result, end) = grammar.parse(Cursor(["1"]), deferred = True)
+        self.assertEqual(result, Result(2))
+
+    def test_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 2
+        expr = OneOf([Token("x").map(lambda value, keeps: 0),
+                      AllOf([Token("("), Lazy(lambda: expr), Token(")")]).map(lambda value, keeps: value[1] + 1)])
+        input = Cursor(["("] * depth + ["x"] + [")"] * depth)
+        for packrat in (False, True):
+            (result, end) = expr.parse(input, packrat = packrat, iterative = True, deferred = True)
+            self.assertEqual(result.value, depth)
+            self.assertTrue(end.empty())
+
+    def test_shared_match_is_mapped_once(self):
+        calls = []
+        for packrat in (False, True):
+            for iterative in (False, True):
+                del calls[:]
+                (result, end) = self.counted(calls).parse(Cursor(["1", "+", "1", "."]), packrat = packrat,
+                                                          iterative = iterative, deferred = True)
+                self.assertEqual(result, Result([2, "."]))
+                self.assertEqual(len(calls), 1)
+
+    def test_compiled(self):
+        calls = []
+        (result, end) = compile(self.counted(calls)).parse(Cursor(["1", "+", "1", "."]), deferred = True)
+        self.assertEqual(result, Result([2, "."]))
+        self.assertEqual(len(calls), 1)
+
+    def test_single_token_run(self):
+        calls = []
+        def to_int(value, keeps):
+            calls.append(value)
+            return int(value)
+        grammar = OneOf([AllOf([OneOrMore(Token("1").map(to_int)), Token(";")]), Token("1")])
+        (result, end) = grammar.parse(Cursor(["1", "1"]), deferred = True)
+        self.assertEqual(result, Result("1"))
+        self.assertEqual(calls, [])
+
+
+class RecognizeTest(unittest.TestCase):
+
+    def grammars(self):
+        item = OneOf([AllOf([Token("("), Lazy(lambda: items), Token(")")]), Unless(Token(")"), AnyToken())])
+        items = OneOrMore(item.map(lambda value, keeps: [value]).keep('item').clear())
+        return [items,
+                OneOf([AllOf([Token("("), Commit(AnyToken()), Token(")")]), AnyToken()]),
+                OneOrMore(OneOf([Token("a"), Token("b")])),
+                AllOf([]),
+                Packrat(AllOf([Token("a"), Token("b")]))]
+
+    def test_same_end_as_parse(self):
+        for tokens in (["a", "(", "b", ")"], ["(", "a", "b"], [")"], ["(", "a"], ["b", "a", "c"], ["a", "b"]):
+            input = Cursor(tokens)
+            for grammar in self.grammars():
+                (result, end) = grammar.parse(input)
+                self.assertEqual(grammar.recognize(input), end.index if result else None)
+                self.assertEqual(compile(grammar).recognize(input), end.index if result else None)
+
+    def test_skips_maps(self):
+        calls = []
+        grammar = AllOf([AnyToken().map(lambda value, keeps: calls.append(value)).keep('a'), Token("b")])
+        self.assertEqual(grammar.recognize(Cursor(["a", "b", "c"])), 2)
+        self.assertEqual(grammar.recognize(Cursor(["a", "a"])), None)
+        self.assertEqual(calls, [])
+
+    def test_scannerless(self):
+        grammar = OneOrMore(OneOf([Literal("ab"), Regex("[0-9]+")]))
+        self.assertEqual(grammar.recognize(Cursor("ab12abx")), 6)
+
+    def test_vocabulary(self):
+        vocabulary = Vocabulary()
+        grammar = compile(AllOf([Token("a"), OneOrMore(Token("b"))]), vocabulary)
+        self.assertEqual(grammar.recognize(Cursor(vocabulary.intern(["a", "b", "b", "a"]))), 3)
+
+    def test_dump_after_recognize(self):
+        grammar = OneOrMore(Token("a"))
+        grammar.recognize(Cursor(["a"]))
+        file = io.BytesIO()
+        dump(grammar, file)
+        file.seek(0)
+        self.assertEqual(load(file).recognize(Cursor(["a", "a"])), 2)
+
+
+class FactorTest(unittest.TestCase):
+
+    def grammars(self):
+        calls = []
+        def count(value, keeps):
+            calls.append(value)
+            return value
+        a = Token("a").map(count)
+        grammar = OneOf([AllOf([a, Token("b"), Token("c")]).map(lambda value, keeps: ["abc"] + value),
+                         AllOf([a, Token("b").keep('b'), Token("d")]),
+                         AllOf([Token("a"), Token("e")]).keep('ae'),
+                         Token("a").mapResult(lambda result: Result(result.value, {'lone': True})),
+                         Token("x")])
+        return (lambda: grammar, calls)
+
+    def test_factors_shared_prefix(self):
+        (build, calls) = self.grammars()
+        grammar = factor(build())
+        self.assertEqual(len(grammar.grammars), 3)
+        self.assertTrue(isinstance(grammar.grammars[0], Factored))
+        self.assertTrue(isinstance(grammar.grammars[1], Factored))
+        self.assertEqual([len(factored.branches) for factored in grammar.grammars[:2]], [2, 2])
+
+    def test_same_results(self):
+        inputs = (["a", "b", "c"], ["a", "b", "d"], ["a", "e"], ["a"], ["a", "b"], ["x"], ["b"])
+        for parse in (lambda grammar, cursor: grammar.parse(cursor),
+                      lambda grammar, cursor: grammar.parse(cursor, packrat = True),
+                      lambda grammar, cursor: grammar.parse(cursor, iterative = True),
+                      lambda grammar, cursor: grammar.parse(cursor, deferred = True),
+                      lambda grammar, cursor: compile(grammar).parse(cursor)):
+            for tokens in inputs:
+                (build, _) = self.grammars()
+                (result, end) = parse(build(), Cursor(tokens))
+                (factored, factored_end) = parse(factor(build()), Cursor(tokens))
+                self.assertEqual(factored and force(factored.value), result and force(result.value))
+                self.assertEqual(factored and factored.keeps, result and result.keeps)
+                self.assertEqual(factored_end.index, end.index)
+
+    def test_parses_prefix_once(self):
+        (build, calls) = self.grammars()
+        build().parse(Cursor(["a", "e"]))
+        self.assertEqual(len(calls), 2)
+        del calls[:]
+        factor(build()).parse(Cursor(["a", "e"]))
+        self.assertEqual(len(calls), 1)
+
+    def test_keeps_order_of_other_alternatives(self):
+        grammar = factor(OneOf([AllOf([Token("a"), Token("b")]), AnyToken().map(lambda value, keeps: "any"),
+                                AllOf([Token("a"), Token("c")])]))
+        self.assertEqual(len(grammar.grammars), 3)
+        self.assertEqual(grammar.parse(Cursor(["a", "c"]))[0].value, "any")
+
+    def test_leaves_commits(self):
+        alternatives = [AllOf([Token("a"), Commit(Token("b")), Token("c")]), AllOf([Token("a"), Token("b")])]
+        grammar = factor(OneOf(list(alternatives)))
+        self.assertEqual(grammar.grammars, alternatives)
+        self.assertEqual(grammar.parse(Cursor(["a", "b", "d"]))[0], None)
+
+    def test_committed_suffix(self):
+        grammar = factor(OneOf([AllOf([Token("a"), Token("b")]),
+                                AllOf([Token("a"), AllOf([Token("c"), Commit(Token("d")), Token("e")])]),
+                                AllOf([Token("a"), Token("c")]),
+                                AnyToken()]))
+        self.assertTrue(isinstance(grammar.grammars[0], Factored))
+        self.assertEqual(grammar.parse(Cursor(["a", "c", "d", "x"]))[0], None)
+        self.assertEqual(grammar.parse(Cursor(["a", "c"]))[0].value, ["a", "c"])
+
+    def arithmetic(self):
+        term = OneOf([AllOf([Token("("), Lazy(lambda: expr), Token(")")]), Token("n")])
+        expr = OneOf([AllOf([term, Token("+"), Lazy(lambda: expr)]),
+                      AllOf([term, Token("-"), Lazy(lambda: expr)]),
+                      term])
+        return expr
+
+    def test_recognize(self):
+        vocabulary = Vocabulary()
+        for text in ("(n+n)-n", "n+", "(n-(n+n))", "(n", "+"):
+            tokens = list(text)
+            (result, end) = self.arithmetic().parse(Cursor(tokens))
+            expected = end.index if result else None
+            grammar = factor(self.arithmetic())
+            self.assertEqual(grammar.recognize(Cursor(tokens)), expected)
+            self.assertEqual(compile(grammar).recognize(Cursor(tokens)), expected)
+            parser = compile(grammar, vocabulary)
+            self.assertEqual(parser.recognize(Cursor(vocabulary.intern(tokens))), expected)
+            self.assertEqual(parser.parse(Cursor(vocabulary.intern(tokens)))[0], result)
+
+    def test_committed_recognize(self):
+        grammar = factor(OneOf([AllOf([Token("a"), Token("b")]),
+                                AllOf([Token("a"), AllOf([Token("c"), Commit(Token("d")), Token("e")])]),
+                                AllOf([Token("a"), Token("c")]),
+                                AnyToken()]))
+        self.assertEqual(grammar.recognize(Cursor(["a", "c", "d", "x"])), None)
+        self.assertEqual(grammar.recognize(Cursor(["a", "c"])), 2)
+        self.assertEqual(grammar.recognize(Cursor(["a", "x"])), 1)
+
+    def test_left_recursion(self):
+        expr = OneOf([AllOf([Lazy(lambda: expr), Token("+"), Token("1")]),
+                      AllOf([Lazy(lambda: expr), Token("-"), Token("1")]),
+                      Token("1")])
+        factor(expr)
+        (result, end) = expr.parse(Cursor(["1", "+", "1", "-", "1"]), packrat = True)
+        self.assertEqual(result.value, [["1", "+", "1"], "-", "1"])
+        self.assertEqual(end.index, 5)
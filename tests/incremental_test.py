@@ -0,0 +1,58 @@
+import unittest
+from grammar import *
+from incremental import IncrementalParse
+from cursor import Cursor
+
+class IncrementalParseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.maps = 0
+        def count(value, keeps):
+            self.maps += 1
+            return (keeps['name'], keeps['value'])
+        value = OneOf([AllOf([Token("("), Lazy(lambda: value), Token(")")]), Token("1"), Token("2")])
+        statement = AllOf([AnyToken().keep('name'), Token("="), value.keep('value'), Token(";")]).map(count)
+        self.grammar = OneOrMore(statement)
+
+    def full_parse(self, tokens):
+        (result, end) = self.grammar.parse(Cursor(tokens))
+        return (result, end.index)
+
+    def check(self, incremental):
+        (result, end) = incremental.parse()
+        self.assertEqual((result, end.index), self.full_parse(incremental.tokens))
+
+    def test_parse(self):
+        self.check(IncrementalParse(self.grammar, ["a", "=", "1", ";"]))
+
+    def test_edit_reparses_only_whats_touched(self):
+        tokens = ["a", "=", "1", ";"] * 20
+        incremental = IncrementalParse(self.grammar, tokens)
+        incremental.parse()
+        self.maps = 0
+        (result, end) = incremental.edit(42, 43, ["(", "2", ")"])
+        self.assertEqual(self.maps, 1)
+        self.assertEqual(result.value[10], ("a", ["(", "2", ")"]))
+        self.assertEqual((result, end.index), self.full_parse(incremental.tokens))
+
+    def test_edits(self):
+        incremental = IncrementalParse(self.grammar, ["a", "=", "1", ";"] * 5)
+        incremental.parse()
+        for (start, stop, tokens) in [(0, 0, ["z", "=", "2", ";"]),      # insert at the start
+                                      (24, 24, ["y", "=", "1", ";"]),    # append at the end
+                                      (6, 7, ["+"]),                     # break a statement
+                                      (6, 7, [";"]),                     # and mend it
+                                      (10, 11, ["(", "(", "1", ")"]),    # half a nested value
+                                      (13, 13, [")"]),                   # the other half
+                                      (4, 12, [])]:                      # delete statements
+            incremental.edit(start, stop, tokens)
+            self.check(incremental)
+
+    def test_left_recursion(self):
+        expr = OneOf([AllOf([Lazy(lambda: expr), Token("+"), Token("1")]), Token("1")])
+        incremental = IncrementalParse(expr, ["1", "+", "1", ")", "+", "1"])
+        incremental.parse()
+        for (start, stop, tokens) in [(3, 4, ["+", "1"]), (1, 2, ["-"]), (1, 2, ["+"])]:
+            (result, end) = incremental.edit(start, stop, tokens)
+            (expected, expected_end) = expr.parse(Cursor(incremental.tokens), packrat = True)
+            self.assertEqual((result, end.index), (expected, expected_end.index))
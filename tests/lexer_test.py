@@ -0,0 +1,50 @@
+import unittest
+from grammar import *
+from lexer import Lexer, Lexemes, Kind
+from cursor import Cursor
+
+class LexerTest(unittest.TestCase):
+
+    def lexer(self):
+        return Lexer([("number", "[0-9]+"), ("op", "[-+]"), ("space", " +")], skip = ["space"])
+
+    def test_tokenize(self):
+        self.assertEqual(self.lexer().tokenize("12 + 3-4"), ["12", "+", "3", "-", "4"])
+
+    def test_first_rule_wins(self):
+        lexer = Lexer([("keyword", "if"), ("word", "[a-z]+")])
+        lexemes = lexer.lex("if")
+        self.assertEqual(lexemes.kind(0), "keyword")
+
+    def test_lex(self):
+        lexemes = self.lexer().lex("12 + 3")
+        self.assertEqual(len(lexemes), 3)
+        self.assertEqual([lexemes[index] for index in range(3)], ["12", "+", "3"])
+        self.assertEqual([lexemes.kind(index) for index in range(3)], ["number", "op", "number"])
+        self.assertEqual(list(lexemes.starts), [0, 3, 5])
+        self.assertEqual(list(lexemes.ends), [2, 4, 6])
+
+    def test_no_matching_rule(self):
+        with self.assertRaises(Exception):
+            self.lexer().tokenize("1 * 2")
+
+    def test_unknown_skip_rule(self):
+        with self.assertRaises(Exception):
+            Lexer([("number", "[0-9]+")], skip = ["space"])
+
+    def test_parse_lexemes(self):
+        lexer = self.lexer()
+        number = lexer.kind("number")
+        grammar = AllOf([number.keep('left'), Token("+"), number.keep('right')]).map(
+            lambda value, keeps: int(keeps['left']) + int(keeps['right']))
+        input = Cursor(lexer.lex("2 + 3 - 1"))
+        (result, end) = grammar.parse(input)
+        self.assertEqual(result.value, 5)
+        self.assertEqual(end.index, 3)
+        self.assertEqual(compile(grammar).parse(input), (result, end))
+        self.assertEqual(grammar.recognize(input), 3)
+
+    def test_kind_does_not_match_other_kinds(self):
+        lexer = self.lexer()
+        (result, _) = lexer.kind("op").parse(Cursor(lexer.lex("2")))
+        self.assertFalse(result)
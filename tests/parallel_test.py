@@ -0,0 +1,67 @@
+import unittest
+from grammar import *
+from parallel import parse_many, parse_chunked, split, load
+from cursor import Cursor
+
+# a grammar with lambdas in it, which workers get by forking or by name
+assignment = AllOf([AnyToken().keep('name'), Token("="), AnyToken().keep('value')]).map(
+    lambda value, keeps: (keeps['name'], keeps['value']))
+
+class ParseManyTest(unittest.TestCase):
+
+    inputs = [["a", "=", "1"], ["b", "=", "2", ";"], ["c", "+", "3"], ["d"]] * 10
+
+    def expected(self):
+        return [(result, end.index) for (result, end) in
+                [assignment.parse(Cursor(tokens)) for tokens in self.inputs]]
+
+    def test_in_process(self):
+        self.assertEqual(list(parse_many(assignment, self.inputs, workers = 1)), self.expected())
+
+    def test_in_process_generators_take_turns(self):
+        a = parse_many(OneOrMore(Token("a")), [["a", "a"]] * 3, workers = 1)
+        b = parse_many(OneOrMore(Token("b")), [["b"]] * 3, workers = 1)
+        self.assertEqual([(a_end, b_end) for ((_, a_end), (_, b_end)) in zip(a, b)], [(2, 1)] * 3)
+
+    def test_in_workers(self):
+        outcomes = parse_many(assignment, self.inputs, workers = 2, chunksize = 3)
+        self.assertEqual(list(outcomes), self.expected())
+
+    def test_tokenize(self):
+        outcomes = parse_many(assignment, ["a = 1", "b + 2"], workers = 2, tokenize = str.split)
+        self.assertEqual([result and result.value for (result, _) in outcomes], [("a", "1"), None])
+
+    def test_load(self):
+        self.assertTrue(load("cursor.Cursor") is Cursor)
+        self.assertTrue(load(assignment) is assignment)
+
+
+class ParseChunkedTest(unittest.TestCase):
+
+    statements = OneOrMore(AllOf([assignment, Token(";")]).map(lambda value, keeps: value[0]))
+
+    def expected(self, tokens):
+        (result, end) = self.statements.parse(Cursor(tokens))
+        return (result, end.index)
+
+    def test_same_as_whole_parse(self):
+        tokens = ["a", "=", "1", ";"] * 50
+        for (workers, chunks) in ((1, 7), (2, None), (2, 200)):
+            outcome = parse_chunked(self.statements, tokens, ";", workers, chunks)
+            self.assertEqual(outcome, self.expected(tokens))
+
+    def test_stops_where_the_parse_stops(self):
+        tokens = ["a", "=", "1", ";"] * 20 + ["b", "+", "2", ";"] + ["c", "=", "3", ";"] * 20
+        self.assertEqual(parse_chunked(self.statements, tokens, ";", 2, 10), self.expected(tokens))
+
+    def test_merges_keeps(self):
+        statements = OneOrMore(AllOf([AnyToken().keep('last'), Token(";")]))
+        tokens = ["a", ";", "b", ";", "c", ";"]
+        (result, end) = parse_chunked(statements, tokens, ";", 1, 3)
+        self.assertEqual(result, statements.parse(Cursor(tokens))[0])
+        self.assertEqual(result.keeps, { 'last': "c" })
+
+    def test_split(self):
+        self.assertEqual(split(["a", ";", "b", "c", ";", "d"], ";", 3),
+                         [["a", ";"], ["b", "c", ";"], ["d"]])
+        self.assertEqual(split([], ";", 3), [])
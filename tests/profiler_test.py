@@ -0,0 +1,65 @@
+import unittest
+from grammar import *
+from profiler import Profile
+from cursor import Cursor
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.number = Token("1")
+        self.sum = AllOf([self.number, Token("+"), self.number])
+        self.grammar = OneOf([AllOf([self.sum, Token(";")]), self.sum])
+        self.input = Cursor(["1", "+", "1", "."])
+
+    def test_counts(self):
+        profile = Profile()
+        (result, end) = self.grammar.parse(self.input, profile = profile)
+        self.assertEqual((result, end), self.grammar.parse(self.input))
+        stats = profile.stats
+        self.assertEqual(stats[self.number].attempts, 4)
+        self.assertEqual(stats[self.sum].attempts, 2)
+        self.assertEqual(stats[self.sum].consumed, 6)
+        self.assertEqual(stats[self.grammar.grammars[0]].failures, 1)
+        self.assertEqual(stats[self.grammar.grammars[0]].wasted, 3)
+        self.assertEqual(stats[self.grammar].wasted, 0)
+
+    def test_times(self):
+        profile = Profile()
+        self.grammar.parse(self.input, profile = profile)
+        top = profile.stats[self.grammar]
+        self.assertAlmostEqual(top.inclusive, sum(stats.exclusive for stats in profile.stats.values()))
+        self.assertTrue(top.exclusive <= top.inclusive)
+
+    def test_adds_up_parses(self):
+        profile = Profile()
+        compile(self.grammar).parse(self.input, profile = profile)
+        self.grammar.parse(self.input, packrat = True, profile = profile)
+        self.assertEqual(profile.stats[self.grammar].attempts, 2)
+        # the second parse finds the sum in the memo table
+        self.assertEqual(profile.stats[self.sum].attempts, 4)
+
+    def test_packrat_grammar(self):
+        profile = Profile()
+        grammar = self.grammar.packrat()
+        grammar.parse(self.input, profile = profile)
+        top = profile.stats[grammar]
+        self.assertAlmostEqual(top.inclusive, sum(stats.exclusive for stats in profile.stats.values()))
+
+    def test_recursion_counted_once(self):
+        profile = Profile()
+        nested = OneOf([AllOf([Token("("), Lazy(lambda: nested), Token(")")]), Token("1")])
+        nested.parse(Cursor(["(", "(", "1", ")", ")"]), profile = profile)
+        top = profile.stats[nested]
+        self.assertEqual(top.attempts, 3)
+        self.assertAlmostEqual(top.inclusive, sum(stats.exclusive for stats in profile.stats.values()))
+
+    def test_report(self):
+        profile = Profile()
+        self.grammar.parse(self.input, profile = profile)
+        lines = profile.report(sort = 'attempts', limit = 2).split("\n")
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith("Token(1)"))
+
+    def test_iterative(self):
+        with self.assertRaises(Exception):
+            self.grammar.parse(self.input, iterative = True, profile = Profile())
@@ -0,0 +1,96 @@
+import unittest
+import io
+import sys
+from grammar import *
+from tracing import *
+from cursor import Cursor
+
+class Recorder(Tracer):
+
+    def __init__(self):
+        self.events = []
+
+    def enter(self, grammar, tokens, index, level):
+        self.events.append(("enter", grammar, index, level))
+
+    def match(self, grammar, index, end, level):
+        self.events.append(("match", grammar, index, end, level))
+
+    def fail(self, grammar, index, level):
+        self.events.append(("fail", grammar, index, level))
+
+    def memo(self, grammar, index, level):
+        self.events.append(("memo", grammar, index, level))
+
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.a = Token("a")
+        self.b = Token("b")
+        self.grammar = OneOf([AllOf([self.a, self.b]), self.a])
+        self.input = Cursor(["a", "c"])
+
+    def tearDown(self):
+        Grammar.trace = False
+
+    def trace(self, tracer, **options):
+        Grammar.trace = tracer
+        try:
+            return self.grammar.parse(self.input, **options)
+        finally:
+            Grammar.trace = False
+
+    def test_events(self):
+        recorder = Recorder()
+        self.assertEqual(self.trace(recorder), self.grammar.parse(self.input))
+        all_of = self.grammar.grammars[0]
+        self.assertEqual(recorder.events,
+                         [("enter", self.grammar, 0, 0),
+                          ("enter", all_of, 0, 1),
+                          ("enter", self.a, 0, 2), ("match", self.a, 0, 1, 2),
+                          ("enter", self.b, 1, 2), ("fail", self.b, 1, 2),
+                          ("fail", all_of, 0, 1),
+                          ("enter", self.a, 0, 1), ("match", self.a, 0, 1, 1),
+                          ("match", self.grammar, 0, 1, 0)])
+
+    def test_memo_events(self):
+        recorder = Recorder()
+        self.trace(recorder, packrat = True)
+        self.assertEqual(recorder.events[-3:], [("fail", self.grammar.grammars[0], 0, 1),
+                                                ("memo", self.a, 0, 1),
+                                                ("match", self.grammar, 0, 1, 0)])
+
+    def test_iterative_events(self):
+        for packrat in (False, True):
+            recursive = Recorder()
+            self.trace(recursive, packrat = packrat)
+            iterative = Recorder()
+            self.trace(iterative, packrat = packrat, iterative = True)
+            self.assertEqual(iterative.events, recursive.events)
+
+    def test_print(self):
+        output = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            self.trace(True)
+        finally:
+            sys.stdout = stdout
+        lines = output.getvalue().split("\n")
+        self.assertEqual(lines[0], "(OneOf([AllOf([Token(a), Token(b)]), Token(a)]), Cursor: ['a', 'c'])")
+        self.assertEqual(lines[3], "--*** match:, Token(a)")
+
+    def test_json_and_binary(self):
+        text = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        self.trace(JsonTracer(text))
+        text.seek(0)
+        events = list(read_json(text))
+        self.assertEqual(events[0], {"event": "node", "node": 0, "name": repr(self.grammar)})
+        self.assertEqual(events[1], {"event": "enter", "node": 0, "index": 0})
+        self.assertEqual(events[-1], {"event": "match", "node": 0, "index": 0, "end": 1})
+        self.assertEqual(len([event for event in events if event["event"] == "node"]), 4)
+        binary = io.BytesIO()
+        self.trace(BinaryTracer(binary))
+        binary.seek(0)
+        self.assertEqual(list(read_binary(binary)), events)
@@ -0,0 +1,145 @@
+import json
+import struct
+from itertools import repeat
+from cursor import Cursor
+
+# Tracers that `Grammar.parse` tells about each grammar it parses, when one is
+# set as `Grammar.trace`: printing the parse as it goes, or writing it to a file
+# to be read back and looked into afterwards.
+
+
+def trace(level, *args):
+    print("".join(repeat("-", level)) + ", ".join(map(str, args)))
+
+
+class Tracer:
+    """
+    Receives an event for each grammar parsed while it's set as
+    `Grammar.trace`: `enter` before the grammar is parsed at `index`, then
+    `match` with the `end` of its match or `fail`, or instead just `memo` if
+    its outcome there was memoized in packrat mode.  `level` is how deep in
+    the grammar tree it is.  These do nothing; override the ones you need.
+    """
+
+    def enter(self, grammar, tokens, index, level):
+        pass
+
+    def match(self, grammar, index, end, level):
+        pass
+
+    def fail(self, grammar, index, level):
+        pass
+
+    def memo(self, grammar, index, level):
+        pass
+
+
+class PrintTracer(Tracer):
+    "Prints each event, indented by its level, as setting `Grammar.trace = True` does."
+
+    def enter(self, grammar, tokens, index, level):
+        trace(level, (grammar, Cursor(tokens, index)))
+
+    def match(self, grammar, index, end, level):
+        trace(level, "*** match:", grammar)
+
+    def fail(self, grammar, index, level):
+        trace(level, "--- no-match:", grammar)
+
+    def memo(self, grammar, index, level):
+        trace(level, "=== memo:", grammar, index)
+
+
+class FileTracer(Tracer):
+    """
+    Writes each event to `file` as a record of the event, the grammar's
+    number and the index, plus the end of a match.  The first time it sees a
+    grammar it numbers it, writing a "node" record of the number and the
+    grammar's name or `trace_repr`, so each grammar is formatted only once.
+    `write(event, node, index, end)` writes a record.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.nodes = {}
+
+    def node(self, grammar):
+        node = self.nodes.get(grammar)
+        if node is None:
+            node = self.nodes[grammar] = len(self.nodes)
+            self.write_node(node, repr(grammar))
+        return node
+
+    def enter(self, grammar, tokens, index, level):
+        self.write("enter", self.node(grammar), index, index)
+
+    def match(self, grammar, index, end, level):
+        self.write("match", self.node(grammar), index, end)
+
+    def fail(self, grammar, index, level):
+        self.write("fail", self.node(grammar), index, index)
+
+    def memo(self, grammar, index, level):
+        self.write("memo", self.node(grammar), index, index)
+
+
+class JsonTracer(FileTracer):
+    """
+    Writes the events to the text `file` as JSON, one object per line, e.g.
+    {"event": "match", "node": 3, "index": 7, "end": 9}
+    with {"event": "node", "node": 3, "name": "..."} before the first event of
+    grammar 3.  Read it back with `read_json`.
+    """
+
+    def write_node(self, node, name):
+        self.file.write(json.dumps({"event": "node", "node": node, "name": name}) + "\n")
+
+    def write(self, event, node, index, end):
+        if event == "match":
+            self.file.write('{"event": "match", "node": %d, "index": %d, "end": %d}\n' % (node, index, end))
+        else:
+            self.file.write('{"event": "%s", "node": %d, "index": %d}\n' % (event, node, index))
+
+
+def read_json(file):
+    "Yields the events written by a `JsonTracer` to `file`, as dictionaries."
+    for line in file:
+        yield json.loads(line)
+
+
+class BinaryTracer(FileTracer):
+    """
+    Writes the events to the binary `file` in a compact form, 13 bytes each:
+    the number of the event in `EVENTS`, then the grammar's number, the index
+    and the end, as 32 bit unsigned integers.  A "node" record is followed by
+    its name, in UTF-8, of the length given as its end.  Read it back with
+    `read_binary`.
+    """
+
+    EVENTS = ("node", "enter", "match", "fail", "memo")
+    CODES = dict((event, code) for (code, event) in enumerate(EVENTS))
+    RECORD = struct.Struct("<BIII")
+
+    def write_node(self, node, name):
+        name = name.encode("utf-8")
+        self.file.write(BinaryTracer.RECORD.pack(0, node, 0, len(name)) + name)
+
+    def write(self, event, node, index, end):
+        self.file.write(BinaryTracer.RECORD.pack(BinaryTracer.CODES[event], node, index, end))
+
+
+def read_binary(file):
+    "Yields the events written by a `BinaryTracer` to `file`, as `read_json` does."
+    record = BinaryTracer.RECORD
+    while True:
+        data = file.read(record.size)
+        if len(data) < record.size:
+            return
+        (code, node, index, end) = record.unpack(data)
+        event = BinaryTracer.EVENTS[code]
+        if event == "node":
+            yield {"event": event, "node": node, "name": file.read(end).decode("utf-8")}
+        elif event == "match":
+            yield {"event": event, "node": node, "index": index, "end": end}
+        else:
+            yield {"event": event, "node": node, "index": index}